@@ -9,22 +9,44 @@
 import os
 import asyncio
 import aiohttp
+from yarl import URL
 import logging
-from datetime import datetime, timedelta
+import hashlib
+import html
+from datetime import date, datetime, timedelta, timezone, time as dt_time
 from typing import Dict, List, Optional, Tuple
 from collections import defaultdict
-import threading
+from functools import lru_cache
+from bisect import bisect_left, bisect_right
 import time
 import json
 import re
-import sys
+
+# 🔎 Нечеткий поиск городов (rapidfuzz), если доступен
+try:
+    from rapidfuzz import fuzz, process as fuzzy_process
+except ImportError:
+    fuzzy_process = None
+
+# ⚡ Быстрый разбор и запись JSON (orjson), если доступен
+try:
+    import orjson
+    json_loads = orjson.loads
+    
+    def json_dumps(data) -> bytes:
+        # id пользователей в словарях - int, orjson нужно разрешить такие ключи
+        return orjson.dumps(data, option=orjson.OPT_NON_STR_KEYS)
+except ImportError:
+    json_loads = json.loads
+    
+    def json_dumps(data) -> bytes:
+        return json.dumps(data, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
 
 from telegram import (
     Update, 
+    Message,
     InlineKeyboardButton, 
-    InlineKeyboardMarkup,
-    ReplyKeyboardMarkup,
-    KeyboardButton
+    InlineKeyboardMarkup
 )
 from telegram.ext import (
     Application,
@@ -33,9 +55,10 @@ from telegram.ext import (
     MessageHandler,
     filters,
     ContextTypes,
-    ConversationHandler
+    AIORateLimiter
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest
 
 # ============= КОНФИГУРАЦИЯ =============
 class Config:
@@ -47,9 +70,9 @@ class Config:
         "йошкар дыра": "Йошкар-Ола",
         "йошкардыра": "Йошкар-Ола",
         "йошкар": "Йошкар-Ола",
-        "йошкарола": "Йошкар-Оla",
-        "йошкар-ола": "Йошкар-Оla",
-        "йошкар ола": "Йошкар-Оla",
+        "йошкарола": "Йошкар-Ола",
+        "йошкар-ола": "Йошкар-Ола",
+        "йошкар ола": "Йошкар-Ола",
         "спб": "Санкт-Петербург",
         "питер": "Санкт-Петербург",
         "петербург": "Санкт-Петербург",
@@ -78,11 +101,70 @@ class Config:
         "токио": "Tokyo"
     }
     
+    # 📍 Координаты известных городов (отвечаем сразу, без геокодинга)
+    KNOWN_CITIES = {
+        "москва": (55.7558, 37.6173, "Москва"),
+        "санкт-петербург": (59.9343, 30.3351, "Санкт-Петербург"),
+        "новосибирск": (55.0084, 82.9357, "Новосибирск"),
+        "екатеринбург": (56.8389, 60.6057, "Екатеринбург"),
+        "казань": (55.7961, 49.1064, "Казань"),
+        "нижний новгород": (56.3269, 44.0065, "Нижний Новгород"),
+        "челябинск": (55.1644, 61.4368, "Челябинск"),
+        "самара": (53.1959, 50.1002, "Самара"),
+        "омск": (54.9893, 73.3686, "Омск"),
+        "ростов-на-дону": (47.2357, 39.7015, "Ростов-на-Дону"),
+        "уфа": (54.7355, 55.9587, "Уфа"),
+        "красноярск": (56.0153, 92.8932, "Красноярск"),
+        "пермь": (58.0105, 56.2502, "Пермь"),
+        "воронеж": (51.6720, 39.1843, "Воронеж"),
+        "волгоград": (48.7080, 44.5133, "Волгоград"),
+        "йошкар-ола": (56.6344, 47.8999, "Йошкар-Ола"),
+        "йошкарола": (56.6344, 47.8999, "Йошкар-Ола"),
+        "йошкар дыра": (56.6344, 47.8999, "Йошкар-Ола"),
+        "йошкардыра": (56.6344, 47.8999, "Йошкар-Ола"),
+        "минск": (53.9006, 27.5590, "Минск"),
+        "киев": (50.4501, 30.5234, "Киев"),
+        "астана": (51.1694, 71.4491, "Астана"),
+        "бишкек": (42.8746, 74.5698, "Бишкек"),
+        "ташкент": (41.2995, 69.2401, "Ташкент"),
+        "алматы": (43.2220, 76.8512, "Алматы"),
+        "баку": (40.4093, 49.8671, "Баку"),
+        "тбилиси": (41.7151, 44.8271, "Тбилиси"),
+        "ереван": (40.1792, 44.4991, "Ереван"),
+        "кишинев": (47.0105, 28.8638, "Кишинев"),
+        "вильнюс": (54.6872, 25.2797, "Вильнюс"),
+        "рига": (56.9496, 24.1052, "Рига"),
+        "таллин": (59.4370, 24.7536, "Таллин"),
+        "лондон": (51.5074, -0.1278, "Лондон"),
+        "нью-йорк": (40.7128, -74.0060, "Нью-Йорк"),
+        "париж": (48.8566, 2.3522, "Париж"),
+        "берлин": (52.5200, 13.4050, "Берлин"),
+        "токио": (35.6762, 139.6503, "Токио"),
+        # Латинские названия - в них псевдонимы переводят зарубежные города
+        "london": (51.5074, -0.1278, "Лондон"),
+        "new york": (40.7128, -74.0060, "Нью-Йорк"),
+        "paris": (48.8566, 2.3522, "Париж"),
+        "berlin": (52.5200, 13.4050, "Берлин"),
+        "tokyo": (35.6762, 139.6503, "Токио")
+    }
+    
+    # 🔎 Поиск опечаток в известных городах
+    FUZZY_SCORE_CUTOFF = 80  # одна замена/перестановка букв в слове от 5 букв
+    FUZZY_MIN_LENGTH = 5
+    
+    # ✏️ Допустимое название города (буквы, цифры, пробелы, дефисы, точки, апострофы)
+    CITY_NAME_MIN_LENGTH = 2
+    CITY_NAME_MAX_LENGTH = 64
+    
     # ⏰ Время для уведомлений (UTC)
     TIME_SLOTS = ["05:00", "06:00", "07:00", "08:00", "09:00", "10:00", 
                  "11:00", "12:00", "13:00", "14:00", "15:00", "16:00", 
                  "17:00", "18:00", "19:00", "20:00", "21:00", "22:00"]
     
+    # 🏙️ Популярные города для быстрого выбора
+    POPULAR_CITIES = ["Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", 
+                      "Казань", "Нижний Новгород", "Йошкар-Ола", "Киев", "Минск"]
+    
     # 🌍 Регионы для быстрого поиска
     REGIONS = ["Россия", "Украина", "Беларусь", "Казахстан", "Узбекистан", 
                "Киргизия", "Азербайджан", "Армения", "Грузия", "Молдова",
@@ -91,16 +173,85 @@ class Config:
     
     # 💾 Файл для сохранения данных
     DATA_FILE = "weather_bot_data.json"
+    CACHE_FILE = "weather_bot_cache.json"  # кэши API отдельно: они большие, а терять их не страшно
+    AUTO_SAVE_INTERVAL = 300  # 5 минут
+    SAVE_DEBOUNCE_INTERVAL = 5  # изменения настроек пишем на диск не чаще, чем раз в 5 секунд
+    
+    # 🔔 Насколько поздно еще можно отправить уведомление (бот был занят или перезапускался)
+    NOTIFICATION_GRACE_PERIOD = 60  # секунд
+    NOTIFICATION_CONCURRENCY = 25  # одновременных отправок (лимит Telegram ~30 сообщений/сек)
     
     # 🗺️ API ключи и URL
     OPENWEATHER_API_KEY = os.getenv("OPENWEATHER_API_KEY", "")
     WEATHER_API_URL = "https://api.openweathermap.org/data/2.5/weather"
     FORECAST_API_URL = "https://api.openweathermap.org/data/2.5/forecast"
+    OPEN_METEO_FORECAST_URL = "https://api.open-meteo.com/v1/forecast"
+    OPEN_METEO_GEOCODING_URL = "https://geocoding-api.open-meteo.com/v1/search"
+    NOMINATIM_SEARCH_URL = "https://nominatim.openstreetmap.org/search"
+    OPENWEATHER_GEOCODING_URL = "http://api.openweathermap.org/geo/1.0/direct"
+    GEODB_PLACES_URL = "http://geodb-free-service.wirefreethought.com/v1/geo/places"
+    
+    # 🌤️ Неизменная часть запроса прогноза (списки полей через запятую)
+    OPEN_METEO_FORECAST_PARAMS = {
+        "current": ",".join([
+            "temperature_2m", "relative_humidity_2m", "apparent_temperature",
+            "precipitation", "rain", "showers", "snowfall", "weather_code",
+            "cloud_cover", "wind_speed_10m", "wind_direction_10m"
+        ]),
+        "daily": ",".join([
+            "temperature_2m_max", "temperature_2m_min",
+            "precipitation_sum", "rain_sum", "showers_sum",
+            "snowfall_sum", "wind_speed_10m_max",
+            "wind_gusts_10m_max", "wind_direction_10m_dominant",
+            "weather_code", "sunrise", "sunset", "daylight_duration"
+        ]),
+        "hourly": "temperature_2m,relative_humidity_2m,precipitation_probability",
+        "timezone": "auto",
+        "forecast_days": 3
+    }
     
     # ⚙️ Настройки пробуждения Render
     RENDER_WAKEUP_INTERVAL = 300  # 5 минут
     MAX_RETRIES = 3
     RETRY_DELAY = 5
+    # Сервер отвечает не сразу, пока Render его поднимает, но соединение
+    # принимается быстро: недоступный адрес не должен съедать все 30 секунд
+    RENDER_WAKEUP_TIMEOUT = aiohttp.ClientTimeout(total=30, connect=5)
+    
+    # ⏱️ Таймауты запросов к API погоды и геокодинга
+    HTTP_TIMEOUT = aiohttp.ClientTimeout(total=5, connect=2)
+    
+    # 🔌 Пул соединений к API (общий для всех запросов)
+    HTTP_POOL_LIMIT = 64
+    HTTP_POOL_LIMIT_PER_HOST = 16
+    HTTP_DNS_CACHE_TTL = 300  # секунд
+    HTTP_KEEPALIVE_TIMEOUT = 75  # секунд
+    
+    # 🚦 Одновременные запросы к API погоды и пауза при ответе 429
+    API_CONCURRENCY = 16
+    API_BACKOFF_BASE = 1  # секунд, удваивается с каждой попыткой
+    
+    # 🤖 Пулы соединений Telegram Bot API
+    TG_CONNECTION_POOL_SIZE = 32
+    TG_GET_UPDATES_POOL_SIZE = 4
+    TG_POOL_TIMEOUT = 10
+    TG_CONNECT_TIMEOUT = 5
+    TG_READ_TIMEOUT = 10
+    
+    # 🚦 Лимиты Telegram: 30 сообщений/сек всего, 20 сообщений/мин в группу
+    TG_OVERALL_MAX_RATE = 30
+    TG_GROUP_MAX_RATE = 20
+    TG_MAX_RETRIES = 1  # повтор после RetryAfter (429)
+    FETCH_TIMEOUT = 8  # секунд на весь поиск города или прогноз
+    
+    # 💾 Время жизни кэша (координаты городов не меняются, погода - меняется)
+    CITY_CACHE_TTL = 30 * 24 * 3600  # 30 дней
+    WEATHER_CACHE_TTL = 600  # 10 минут
+    WEATHER_STALE_TTL = 3600  # еще час показываем старый прогноз, если API недоступен
+    CITY_MISS_TTL = 60  # не найденный город не ищем повторно минуту
+    RENDER_CACHE_TTL = 10  # готовый текст погоды (повторные нажатия, рассылка по одному городу)
+    CACHE_MAX_ENTRIES = 512  # на каждый кэш
+    RENDERED_MESSAGES_MAX = 1000  # сообщений, для которых помним отправленное содержимое
 
 # ============= ЛОГГИРОВАНИЕ =============
 logging.basicConfig(
@@ -109,76 +260,383 @@ logging.basicConfig(
 )
 logger = logging.getLogger(__name__)
 
+# 🔇 httpx (внутри python-telegram-bot) пишет в INFO каждый запрос к Bot API
+logging.getLogger("httpx").setLevel(logging.WARNING)
+logging.getLogger("aiohttp.access").setLevel(logging.WARNING)
+
 # ============= СОСТОЯНИЯ ДИАЛОГА =============
 CITY_INPUT, NOTIFICATION_CITY, NOTIFICATION_TIME = range(3)
 
+# ============= ТЕКСТЫ СООБЩЕНИЙ =============
+WELCOME_TEMPLATE = (
+    "✨ <b>Добро пожаловать, {name}!</b> ✨\n\n"
+    "🌤️ <b>Weather Bot</b> - умный поиск погоды\n\n"
+    "<i>Что я умею:</i>\n"
+    "• 🔍 Находить <b>любой город</b> через API\n"
+    "• 🌍 Искать по <b>регионам</b> по всему миру\n"
+    "• 🌤️ Показывать <b>детальный прогноз</b> на 3 дня\n"
+    "• ⏰ Отправлять <b>уведомления</b>\n"
+    "• 💾 <b>Сохранять настройки</b> между перезапусками\n\n"
+    "<b>Попробуйте ввести название города или выберите действие:</b>"
+)
+
+HELP_TEXT = (
+    "ℹ️ <b>Справка по Weather Bot</b>\n\n"
+    "🔍 <b>Поиск города:</b>\n"
+    "• Введите название города на русском или английском\n"
+    "• Используйте псевдонимы (йошкар дыра, спб, питер)\n"
+    "• Ищите по регионам через меню\n\n"
+    "⏰ <b>Уведомления:</b>\n"
+    "• Выберите город для уведомлений\n"
+    "• Укажите время в формате UTC\n"
+    "• Включите/выключите уведомления\n"
+    "• Все настройки сохраняются автоматически\n\n"
+    "🌤️ <b>Что показывает прогноз:</b>\n"
+    "• Текущую температуру и ощущаемую\n"
+    "• Скорость и направление ветра\n"
+    "• Влажность и облачность\n"
+    "• Восход и закат солнца\n"
+    "• Прогноз на 3 дня вперед\n\n"
+    "💾 <b>Автосохранение:</b>\n"
+    "• Все ваши настройки сохраняются каждые 5 минут\n"
+    "• Данные сохраняются между перезапусками бота\n"
+    "• Вы можете удалить настройки в любое время\n\n"
+    "<i>Начните с команды /start или введите название города!</i>"
+)
+
+MAIN_MENU_TEXT = (
+    "🌤️ <b>Главное меню</b>\n\n"
+    "<i>Выберите действие:</i>"
+)
+
+QUICK_CITIES_TEXT = (
+    "🏙️ <b>Популярные города:</b>\n\n"
+    "<i>Выберите город из списка или найдите другой</i>"
+)
+
+FIND_CITY_TEXT = (
+    "🔍 <b>Введите название города:</b>\n\n"
+    "<i>Я найду любой город через API!</i>\n"
+    "<i>Примеры: Москва, Йошкар-Ола, Лондон, Нью-Йорк</i>\n"
+    "<i>Псевдонимы: йошкар дыра, спб, питер, нск</i>"
+)
+
+REGIONS_TEXT = (
+    "🌍 <b>Выберите регион:</b>\n\n"
+    "<i>Я найду города в выбранном регионе</i>"
+)
+
+STALE_BUTTON_TEXT = (
+    "⚠️ <b>Эта кнопка устарела</b>\n\n"
+    "<i>Выберите город заново или введите его название</i>"
+)
+
+NOTIF_INFO_EMPTY_TEXT = (
+    "📊 <b>Информация об уведомлениях</b>\n\n"
+    "❌ <b>Уведомления не настроены</b>\n\n"
+    "<i>Для настройки уведомлений:</i>\n"
+    "1. Выберите город\n"
+    "2. Укажите время (UTC)\n"
+    "3. Включите уведомления\n\n"
+    "<i>Все настройки будут автоматически сохранены.</i>"
+)
+
+NOTIF_CITY_TEXT = (
+    "📍 <b>Введите город для уведомлений:</b>\n\n"
+    "<i>Пример: Москва, Йошкар-Ола, Лондон</i>\n"
+    "<i>Можно использовать псевдонимы</i>"
+)
+
+NOTIF_TIME_TEXT = (
+    "⏰ <b>Выберите время уведомления (UTC):</b>\n\n"
+    "<i>Бот работает по времени UTC.</i>\n"
+    "<i>Пример для Москвы (UTC+3):</i>\n"
+    "<i>Если хотите получать в 9:00 по Москве, выберите 6:00 UTC</i>"
+)
+
+NOTIF_MENU_EMPTY_TEXT = (
+    "⏰ <b>Настройка уведомлений</b>\n\n"
+    "<i>Получайте ежедневный прогноз погоды!</i>\n\n"
+    "<b>Как настроить:</b>\n"
+    "1. 📍 Выберите город\n"
+    "2. ⏰ Укажите время (UTC)\n"
+    "3. 🔔 Включите уведомления\n\n"
+    "<i>Пример для Москвы (UTC+3):</i>\n"
+    "<i>Для получения уведомления в 9:00 по Москве</i>\n"
+    "<i>выберите 6:00 UTC</i>\n\n"
+    "💾 <i>Все настройки сохраняются автоматически</i>"
+)
+
+WEEKDAYS = ("Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс")
+
+# Строка прогноза на один день
+DAY_FORECAST_TEMPLATE = "  {emoji} <b>{day} {date}:</b> <code>{min_temp:.0f}°...{max_temp:.0f}°</code>"
+
+# Карточка погоды: постоянная часть собрана заранее, необязательные
+# строки подставляются готовыми кусками (пустая строка, если их нет)
+WEATHER_TEMPLATE = (
+    "✨ <b>{weather_emoji} Погода в {city}</b> ✨\n"
+    "══════════════════════════════════\n"
+    "{temp_emoji} <b>Температура:</b> <code>{temp:.1f}°C</code>\n"
+    "{feels_like_line}"
+    "{wind_emoji} <b>Ветер:</b> <code>{wind_speed:.1f} м/с</code> {wind_dir}\n"
+    "💧 <b>Влажность:</b> <code>{humidity:.0f}%</code>\n"
+    "☁️ <b>Облачность:</b> <code>{cloud_cover:.0f}%</code>\n"
+    "{precip_line}"
+    "{sun_lines}"
+    "📝 <b>Описание:</b> {description}\n"
+    "{days_block}"
+    "══════════════════════════════════\n"
+    "🕐 <i>Обновлено: {updated_at}</i>"
+    "{stale_line}"
+)
+FEELS_LIKE_TEMPLATE = "🌡️ <b>Ощущается как:</b> <code>{:.1f}°C</code>\n"
+PRECIP_TEMPLATE = "{} <b>Осадки сегодня:</b> <code>{:.1f} мм</code>\n"
+SUN_TEMPLATE = "🌅 <b>Восход:</b> <code>{}</code>\n🌇 <b>Закат:</b> <code>{}</code>\n"
+# Заголовок по числу дней с данными
+DAYS_HEADERS = {
+    1: "\n📅 <b>Прогноз на 1 день:</b>\n",
+    2: "\n📅 <b>Прогноз на 2 дня:</b>\n",
+    3: "\n📅 <b>Прогноз на 3 дня:</b>\n",
+}
+STALE_NOTE = "\n⚠️ <i>Сервис погоды недоступен, данные из кэша</i>"
+
+INVALID_CITY_TEXT = (
+    "❌ <b>Неверное название города</b>\n\n"
+    f"<i>Используйте буквы, пробелы и дефисы, от {Config.CITY_NAME_MIN_LENGTH} "
+    f"до {Config.CITY_NAME_MAX_LENGTH} символов</i>"
+)
+
+ERROR_TEXT = (
+    "❌ <b>Произошла ошибка</b>\n\n"
+    "<i>Попробуйте снова или выберите действие из меню</i>"
+)
+
 # ============= ГЛОБАЛЬНОЕ ХРАНИЛИЩЕ =============
 user_sessions = defaultdict(dict)
 weather_cache = {}
 notifications = defaultdict(dict)
 last_notification = {}
 city_cache = {}
+city_misses = {}  # города, которые API не нашли (не сохраняется)
+rendered_weather = {}  # город -> готовый текст погоды (не сохраняется)
+
+# 🔔 Индекс включенных уведомлений по времени: "HH:MM" -> user_id,
+# чтобы каждую проверку не перебирать всех пользователей
+notifications_by_time: Dict[str, set] = defaultdict(set)
+notification_slots = {}  # user_id -> время, под которым пользователь в индексе
+
+# 🔢 Telegram ограничивает callback_data 64 байтами, поэтому в кнопки
+# городов кладем короткий стабильный хэш вместо названия
+city_callbacks: Dict[str, str] = {}
+callback_cities: Dict[str, str] = {}
+
+# ✏️ Хэш последнего отправленного содержимого: (chat_id, message_id) -> hash
+rendered_messages: Dict[Tuple[int, int], int] = {}
+
+# 🔒 Запросы погоды одного пользователя выполняются по очереди.
+# Замок хранится, пока его кто-то держит или ждет: user_id -> (замок, число запросов)
+weather_locks: Dict[int, Tuple[asyncio.Lock, int]] = {}
+
+# 🛬 Запросы к API, которые выполняются прямо сейчас: ключ -> задача
+inflight_requests: Dict[str, asyncio.Task] = {}
+
+async def single_flight(key: str, fetch):
+    """🛬 Одинаковые одновременные запросы выполняются один раз, результат - всем"""
+    task = inflight_requests.get(key)
+    if task is None:
+        task = asyncio.create_task(fetch())
+        inflight_requests[key] = task
+        task.add_done_callback(lambda _: inflight_requests.pop(key, None))
+    # shield: отмена одного ожидающего не отменяет запрос для остальных
+    return await asyncio.shield(task)
+
+def cache_get(cache: Dict, key: str, allow_stale: bool = False):
+    """💾 Значение из кэша, если срок его жизни не истек"""
+    entry = cache.get(key)
+    if entry is not None:
+        fresh_until, stale_until, value = entry
+        if time.time() < (stale_until if allow_stale else fresh_until):
+            return value
+    return None
+
+def cache_put(cache: Dict, key: str, value, ttl: float, stale_ttl: float = 0):
+    """💾 Запись в кэш с вытеснением самых старых записей"""
+    # Перевставляем ключ, чтобы порядок словаря совпадал с возрастом записей
+    cache.pop(key, None)
+    while len(cache) >= Config.CACHE_MAX_ENTRIES:
+        del cache[next(iter(cache))]
+    # Храним моменты истечения (time.time, а не monotonic - кэши сохраняются в файл):
+    # свежая запись и устаревшая, которую еще можно показать при сбое API
+    fresh_until = time.time() + ttl
+    cache[key] = (fresh_until, fresh_until + stale_ttl, value)
 
 # ============= СИСТЕМА СОХРАНЕНИЯ ДАННЫХ =============
-def save_data_to_file():
-    """💾 Сохраняет все данные в файл"""
+# Настройки изменились, но еще не записаны на диск
+data_dirty = False
+
+def mark_data_dirty():
+    """📝 Отмечает, что данные нужно сохранить (запись делает flush_data_job)"""
+    global data_dirty
+    data_dirty = True
+
+# Автосохранение и сброс изменений не должны писать файлы одновременно
+save_lock = asyncio.Lock()
+
+def replace_file(path: str, payload: bytes):
+    """💾 Записывает байты во временный файл и подменяет им старый"""
+    # Сбой посреди записи не испортит уже сохраненные данные
+    tmp_file = path + ".tmp"
+    # Готовый буфер уходит на диск одной записью, без текстовой обертки
+    with open(tmp_file, 'wb') as f:
+        f.write(payload)
+        f.flush()
+        # Данные должны оказаться на диске до подмены файла
+        os.fsync(f.fileno())
+    os.replace(tmp_file, path)
+
+async def write_json_file(path: str, data: Dict):
+    """💾 Сохраняет данные в JSON-файл, не блокируя event loop"""
+    # Сериализуем здесь же: обработчики меняют словари, и в другом потоке
+    # json мог бы застать их посреди изменения
+    # Без отступов: файл в несколько раз меньше и пишется быстрее
+    payload = json_dumps(data)
+    async with save_lock:
+        # Медленный диск не должен задерживать ответы пользователям
+        await asyncio.to_thread(replace_file, path, payload)
+
+async def save_data_to_file():
+    """💾 Сохраняет данные пользователей в файл"""
+    global data_dirty
+    data_dirty = False
     try:
-        data_to_save = {
+        await write_json_file(Config.DATA_FILE, {
             "user_sessions": dict(user_sessions),
             "notifications": dict(notifications),
-            "last_notification": dict(last_notification),
+            # date не сериализуется в JSON - храним как YYYY-MM-DD
+            "last_notification": {user_id: sent.isoformat() for user_id, sent in last_notification.items()},
             "saved_at": datetime.now().isoformat()
-        }
+        })
         
-        with open(Config.DATA_FILE, 'w', encoding='utf-8') as f:
-            json.dump(data_to_save, f, ensure_ascii=False, indent=2)
-        
-        logger.info(f"💾 Данные сохранены в {Config.DATA_FILE}")
+        logger.info("💾 Данные сохранены в %s", Config.DATA_FILE)
+        return True
+    except Exception as e:
+        logger.error("❌ Ошибка сохранения данных: %s", e)
+        data_dirty = True  # попробуем снова при следующей проверке
+        return False
+
+async def save_caches_to_file():
+    """💾 Сохраняет кэши API в отдельный файл"""
+    # Кэши меняются при каждом запросе погоды, поэтому пишем их только
+    # при автосохранении и остановке, а не вместе с настройками пользователей
+    try:
+        await write_json_file(Config.CACHE_FILE, {
+            "weather_cache": dict(weather_cache),
+            "city_cache": dict(city_cache)
+        })
         return True
     except Exception as e:
-        logger.error(f"❌ Ошибка сохранения данных: {e}")
+        logger.error("❌ Ошибка сохранения кэша: %s", e)
         return False
 
 def load_data_from_file():
     """📂 Загружает данные из файла"""
     try:
         if os.path.exists(Config.DATA_FILE):
-            with open(Config.DATA_FILE, 'r', encoding='utf-8') as f:
-                data = json.load(f)
+            with open(Config.DATA_FILE, 'rb') as f:
+                data = json_loads(f.read())
             
+            # JSON хранит ключи строками, а обработчики ищут пользователя по int id
             # Загружаем user_sessions
             user_sessions.clear()
-            user_sessions.update(data.get("user_sessions", {}))
+            user_sessions.update({int(user_id): session for user_id, session in data.get("user_sessions", {}).items()})
             
             # Загружаем notifications
             notifications.clear()
-            notifications.update(data.get("notifications", {}))
+            notifications.update({int(user_id): notif for user_id, notif in data.get("notifications", {}).items()})
+            notifications_by_time.clear()
+            notification_slots.clear()
+            for user_id in notifications:
+                reindex_notification(user_id)
             
             # Загружаем last_notification
             last_notification.clear()
-            last_notification.update(data.get("last_notification", {}))
+            last_notification.update({
+                int(user_id): date.fromisoformat(sent) for user_id, sent in data.get("last_notification", {}).items()
+            })
+            
+            # Старые версии бота хранили кэши вместе с данными пользователей
+            load_caches_from_file(data)
             
             saved_at = data.get("saved_at", "неизвестно")
-            logger.info(f"📂 Данные загружены из {Config.DATA_FILE}")
-            logger.info(f"📊 Пользователей: {len(user_sessions)}")
-            logger.info(f"🔔 Уведомлений: {len(notifications)}")
-            logger.info(f"🕐 Сохранено: {saved_at}")
+            logger.info("📂 Данные загружены из %s", Config.DATA_FILE)
+            logger.info("📊 Пользователей: %s", len(user_sessions))
+            logger.info("🔔 Уведомлений: %s", len(notifications))
+            logger.info("🗺️ Городов в кэше: %s, прогнозов: %s", len(city_cache), len(weather_cache))
+            logger.info("🕐 Сохранено: %s", saved_at)
             return True
     except Exception as e:
-        logger.error(f"❌ Ошибка загрузки данных: {e}")
+        logger.error("❌ Ошибка загрузки данных: %s", e)
     
     return False
 
-def auto_save_worker():
+def load_caches_from_file(legacy_data: Dict):
+    """🗺️ Прогревает кэши, чтобы после перезапуска не ходить в API заново"""
+    try:
+        data = legacy_data
+        if os.path.exists(Config.CACHE_FILE):
+            with open(Config.CACHE_FILE, 'rb') as f:
+                data = json_loads(f.read())
+        
+        now = time.time()
+        weather_cache.clear()
+        for key, entry in data.get("weather_cache", {}).items():
+            if len(entry) == 3 and now < entry[1]:
+                weather_cache[key] = tuple(entry)
+        
+        city_cache.clear()
+        for key, entry in data.get("city_cache", {}).items():
+            if len(entry) == 3 and now < entry[1]:
+                fresh_until, stale_until, city_data = entry
+                city_cache[key] = (fresh_until, stale_until, tuple(city_data))
+    except Exception as e:
+        # Без кэша бот работает, просто первые запросы пойдут в API
+        logger.error("❌ Ошибка загрузки кэша: %s", e)
+
+async def auto_save_job(context: ContextTypes.DEFAULT_TYPE):
     """🔄 Автоматическое сохранение данных каждые 5 минут"""
-    def save_loop():
-        while True:
-            time.sleep(Config.RENDER_WAKEUP_INTERVAL)  # 5 минут
-            save_data_to_file()
-    
-    save_thread = threading.Thread(target=save_loop, daemon=True)
-    save_thread.start()
-    logger.info("💾 Служба автосохранения запущена")
+    await save_data_to_file()
+    await save_caches_to_file()
+
+async def flush_data_job(context: ContextTypes.DEFAULT_TYPE):
+    """💾 Сохраняет накопившиеся изменения одной записью"""
+    if data_dirty:
+        await save_data_to_file()
+
+# ============= HTTP-СЕССИЯ =============
+# Одна сессия aiohttp на весь бот: keep-alive соединения и DNS-кэш
+# переиспользуются всеми запросами к API
+http_session: Optional[aiohttp.ClientSession] = None
+
+def get_http_session() -> aiohttp.ClientSession:
+    """🔌 Общая сессия aiohttp с пулом соединений"""
+    global http_session
+    if http_session is None or http_session.closed:
+        connector = aiohttp.TCPConnector(
+            limit=Config.HTTP_POOL_LIMIT,
+            limit_per_host=Config.HTTP_POOL_LIMIT_PER_HOST,
+            ttl_dns_cache=Config.HTTP_DNS_CACHE_TTL,
+            keepalive_timeout=Config.HTTP_KEEPALIVE_TIMEOUT
+        )
+        http_session = aiohttp.ClientSession(connector=connector, timeout=Config.HTTP_TIMEOUT)
+    return http_session
+
+async def close_http_session():
+    """🔌 Закрывает общую сессию aiohttp"""
+    global http_session
+    if http_session is not None and not http_session.closed:
+        await http_session.close()
+    http_session = None
 
 # ============= ПРОБУЖДЕНИЕ RENDER =============
 async def wakeup_render_async():
@@ -189,92 +647,94 @@ async def wakeup_render_async():
     
     for attempt in range(Config.MAX_RETRIES):
         try:
-            logger.info(f"🔄 Попытка пробуждения Render (попытка {attempt + 1}/{Config.MAX_RETRIES})...")
+            logger.info("🔄 Попытка пробуждения Render (попытка %s/%s)...", attempt + 1, Config.MAX_RETRIES)
             
-            async with aiohttp.ClientSession() as session:
-                timeout = aiohttp.ClientTimeout(total=30)
-                async with session.get(Config.RENDER_WAKEUP_URL, timeout=timeout) as response:
-                    if response.status in [200, 201, 202, 204]:
-                        logger.info("✅ Render успешно пробужден")
-                        return True
-                    else:
-                        logger.warning(f"⚠️ Render ответил статусом {response.status}")
-                        
+            session = get_http_session()
+            async with session.get(Config.RENDER_WAKEUP_URL, timeout=Config.RENDER_WAKEUP_TIMEOUT) as response:
+                if response.status in [200, 201, 202, 204]:
+                    logger.info("✅ Render успешно пробужден")
+                    return True
+                else:
+                    logger.warning("⚠️ Render ответил статусом %s", response.status)
+                    
         except aiohttp.ClientError as e:
-            logger.error(f"❌ Ошибка сети при пробуждении Render: {e}")
+            logger.error("❌ Ошибка сети при пробуждении Render: %s", e)
         except asyncio.TimeoutError:
             logger.error("⏰ Таймаут при пробуждении Render")
         except Exception as e:
-            logger.error(f"❌ Неожиданная ошибка при пробуждении Render: {e}")
+            logger.error("❌ Неожиданная ошибка при пробуждении Render: %s", e)
         
         if attempt < Config.MAX_RETRIES - 1:
-            logger.info(f"⏳ Повтор через {Config.RETRY_DELAY} секунд...")
+            logger.info("⏳ Повтор через %s секунд...", Config.RETRY_DELAY)
             await asyncio.sleep(Config.RETRY_DELAY)
     
     logger.error("❌ Не удалось пробудить Render после всех попыток")
     return False
 
-def render_wakeup_worker():
-    """⏰ Рабочий поток для пробуждения Render"""
-    async def wakeup_loop():
-        logger.info("⏰ Служба пробуждения Render запущена")
-        
-        while True:
-            try:
-                success = await wakeup_render_async()
-                
-                if success:
-                    logger.info(f"✅ Успешное пробуждение в {datetime.now().strftime('%H:%M:%S')}")
-                else:
-                    logger.warning(f"⚠️ Пробуждение не удалось в {datetime.now().strftime('%H:%M:%S')}")
-                
-                # Ждем перед следующим пробуждением
-                await asyncio.sleep(Config.RENDER_WAKEUP_INTERVAL)
-                
-            except Exception as e:
-                logger.error(f"❌ Критическая ошибка в wakeup_loop: {e}")
-                await asyncio.sleep(60)  # Ждем минуту перед повторной попыткой
-    
-    def run_wakeup():
-        try:
-            loop = asyncio.new_event_loop()
-            asyncio.set_event_loop(loop)
-            loop.run_until_complete(wakeup_loop())
-        except KeyboardInterrupt:
-            logger.info("👋 Служба пробуждения остановлена")
-        except Exception as e:
-            logger.error(f"❌ Фатальная ошибка в run_wakeup: {e}")
-    
-    wakeup_thread = threading.Thread(target=run_wakeup, daemon=True)
-    wakeup_thread.start()
-    logger.info("✅ Служба пробуждения Render запущена в отдельном потоке")
+async def render_wakeup_job(context: ContextTypes.DEFAULT_TYPE):
+    """⏰ Периодическое пробуждение Render"""
+    if await wakeup_render_async():
+        logger.info("✅ Успешное пробуждение")
+    else:
+        logger.warning("⚠️ Пробуждение не удалось")
 
 # ============= ОСТАВШИЕСЯ ФУНКЦИИ (остаются без изменений) =============
 
+def get_known_city(city_name: str) -> Optional[Tuple[float, float, str]]:
+    """🗺️ Координаты из встроенного списка городов, без геокодинга"""
+    real_name = city_lookup.get(" ".join(city_name.lower().split()))
+    if real_name:
+        return Config.KNOWN_CITIES.get(real_name.lower())
+    return Config.KNOWN_CITIES.get(normalize_city(city_name).lower())
+
+def get_known_city_typo(city_name: str) -> Optional[Tuple[float, float, str]]:
+    """🔎 Координаты известного города, если название введено с опечаткой"""
+    typo_match = match_known_city_typo(city_name)
+    return Config.KNOWN_CITIES[typo_match] if typo_match else None
+
 async def search_city_api(city_name: str) -> Optional[Tuple[float, float, str]]:
     """Ищет город через несколько бесплатных API"""
     
+    # Известный город - координаты есть локально, API не нужен
+    known_city = get_known_city(city_name)
+    if known_city:
+        return known_city
+    
     # Сначала проверяем псевдонимы
     normalized = normalize_city(city_name)
     if normalized != city_name:
         city_name = normalized
     
-    # Кэшируем результаты на 1 час
+    # Координаты кэшируем надолго, отдельно от погоды
     cache_key = f"city_search_{city_name.lower()}"
-    if cache_key in city_cache:
-        timestamp, data = city_cache[cache_key]
-        if time.time() - timestamp < 3600:
-            return data
+    cached = cache_get(city_cache, cache_key)
+    if cached:
+        return cached
+    
+    # Ту же опечатку не отправляем в API повторно
+    if cache_get(city_misses, cache_key):
+        return get_known_city_typo(city_name)
+    
+    # Одновременные поиски одного города идут в API одним запросом
+    city_data = await single_flight(cache_key, lambda: geocode_city(city_name, cache_key))
     
+    # Опечатку в известном городе исправляем, только если API такого города
+    # не знает: иначе настоящий "Пинск" превратился бы в "Минск"
+    return city_data or get_known_city_typo(city_name)
+
+async def geocode_city(city_name: str, cache_key: str) -> Optional[Tuple[float, float, str]]:
+    """🌍 Запрос координат города к API с запасным списком известных городов"""
     try:
-        async with aiohttp.ClientSession() as session:
+        # ⏱️ Общий бюджет на все API, чтобы зависший запрос не держал соединения
+        async with asyncio.timeout(Config.FETCH_TIMEOUT):
+            session = get_http_session()
             
             # 1️⃣ Open-Meteo Geocoding API (лучший для погоды)
             try:
-                url = f"https://geocoding-api.open-meteo.com/v1/search?name={city_name}&count=1&language=ru"
-                async with session.get(url, timeout=5) as response:
+                params = {"name": city_name, "count": 1, "language": "ru"}
+                async with session.get(Config.OPEN_METEO_GEOCODING_URL, params=params) as response:
                     if response.status == 200:
-                        data = await response.json()
+                        data = json_loads(await response.read())
                         if data.get("results"):
                             result = data["results"][0]
                             lat = result["latitude"]
@@ -283,18 +743,18 @@ async def search_city_api(city_name: str) -> Optional[Tuple[float, float, str]]:
                             
                             # Сохраняем в кэш
                             result_data = (lat, lon, name)
-                            city_cache[cache_key] = (time.time(), result_data)
+                            cache_put(city_cache, cache_key, result_data, Config.CITY_CACHE_TTL)
                             return result_data
-            except:
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
                 pass
             
             # 2️⃣ OpenStreetMap Nominatim API
             try:
-                url = f"https://nominatim.openstreetmap.org/search?q={city_name}&format=json&limit=1&accept-language=ru"
+                params = {"q": city_name, "format": "json", "limit": 1, "accept-language": "ru"}
                 headers = {'User-Agent': 'WeatherBot/1.0'}
-                async with session.get(url, headers=headers, timeout=5) as response:
+                async with session.get(Config.NOMINATIM_SEARCH_URL, params=params, headers=headers) as response:
                     if response.status == 200:
-                        data = await response.json()
+                        data = json_loads(await response.read())
                         if data:
                             result = data[0]
                             lat = float(result["lat"])
@@ -302,18 +762,18 @@ async def search_city_api(city_name: str) -> Optional[Tuple[float, float, str]]:
                             name = result.get("display_name", city_name).split(",")[0]
                             
                             result_data = (lat, lon, name)
-                            city_cache[cache_key] = (time.time(), result_data)
+                            cache_put(city_cache, cache_key, result_data, Config.CITY_CACHE_TTL)
                             return result_data
-            except:
+            except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
                 pass
             
             # 3️⃣ OpenWeatherMap Geocoding API (если есть ключ)
             if Config.OPENWEATHER_API_KEY:
                 try:
-                    url = f"http://api.openweathermap.org/geo/1.0/direct?q={city_name}&limit=1&appid={Config.OPENWEATHER_API_KEY}"
-                    async with session.get(url, timeout=5) as response:
+                    params = {"q": city_name, "limit": 1, "appid": Config.OPENWEATHER_API_KEY}
+                    async with session.get(Config.OPENWEATHER_GEOCODING_URL, params=params) as response:
                         if response.status == 200:
-                            data = await response.json()
+                            data = json_loads(await response.read())
                             if data:
                                 result = data[0]
                                 lat = result["lat"]
@@ -321,103 +781,119 @@ async def search_city_api(city_name: str) -> Optional[Tuple[float, float, str]]:
                                 name = result.get("name", city_name)
                                 
                                 result_data = (lat, lon, name)
-                                city_cache[cache_key] = (time.time(), result_data)
+                                cache_put(city_cache, cache_key, result_data, Config.CITY_CACHE_TTL)
                                 return result_data
-                except:
+                except (aiohttp.ClientError, asyncio.TimeoutError, KeyError, ValueError):
                     pass
-            
-            # 4️⃣ Простой поиск для известных городов
-            known_cities = {
-                "москва": (55.7558, 37.6173, "Москва"),
-                "санкт-петербург": (59.9343, 30.3351, "Санкт-Петербург"),
-                "новосибирск": (55.0084, 82.9357, "Новосибирск"),
-                "екатеринбург": (56.8389, 60.6057, "Екатеринбург"),
-                "казань": (55.7961, 49.1064, "Казань"),
-                "нижний новгород": (56.3269, 44.0065, "Нижний Новгород"),
-                "челябинск": (55.1644, 61.4368, "Челябинск"),
-                "самара": (53.1959, 50.1002, "Самара"),
-                "омск": (54.9893, 73.3686, "Омск"),
-                "ростов-на-дону": (47.2357, 39.7015, "Ростов-на-Дону"),
-                "уфа": (54.7355, 55.9587, "Уфа"),
-                "красноярск": (56.0153, 92.8932, "Красноярск"),
-                "пермь": (58.0105, 56.2502, "Пермь"),
-                "воронеж": (51.6720, 39.1843, "Воронеж"),
-                "волгоград": (48.7080, 44.5133, "Волгоград"),
-                "йошкар-ола": (56.6344, 47.8999, "Йошкар-Ола"),
-                "йошкарола": (56.6344, 47.8999, "Йошкар-Ола"),
-                "йошкар дыра": (56.6344, 47.8999, "Йошкар-Ола"),
-                "йошкардыра": (56.6344, 47.8999, "Йошкар-Ола"),
-                "минск": (53.9006, 27.5590, "Минск"),
-                "киев": (50.4501, 30.5234, "Киев"),
-                "астана": (51.1694, 71.4491, "Астана"),
-                "бишкек": (42.8746, 74.5698, "Бишкек"),
-                "ташкент": (41.2995, 69.2401, "Ташкент"),
-                "алматы": (43.2220, 76.8512, "Алматы"),
-                "баку": (40.4093, 49.8671, "Баку"),
-                "тбилиси": (41.7151, 44.8271, "Тбилиси"),
-                "ереван": (40.1792, 44.4991, "Ереван"),
-                "кишинев": (47.0105, 28.8638, "Кишинев"),
-                "вильнюс": (54.6872, 25.2797, "Вильнюс"),
-                "рига": (56.9496, 24.1052, "Рига"),
-                "таллин": (59.4370, 24.7536, "Таллин"),
-                "лондон": (51.5074, -0.1278, "Лондон"),
-                "нью-йорк": (40.7128, -74.0060, "Нью-Йорк"),
-                "париж": (48.8566, 2.3522, "Париж"),
-                "берлин": (52.5200, 13.4050, "Берлин"),
-                "токио": (35.6762, 139.6503, "Токио")
-            }
-            
-            city_lower = city_name.lower()
-            if city_lower in known_cities:
-                result_data = known_cities[city_lower]
-                city_cache[cache_key] = (time.time(), result_data)
-                return result_data
-            
+    
+    except asyncio.TimeoutError:
+        logger.warning("⏰ Таймаут поиска города %s (%s сек)", city_name, Config.FETCH_TIMEOUT)
     except Exception as e:
-        logger.error(f"❌ Ошибка поиска города {city_name}: {e}")
+        logger.error("❌ Ошибка поиска города %s: %s", city_name, e)
     
+    cache_put(city_misses, cache_key, True, Config.CITY_MISS_TTL)
     return None
 
 async def search_cities_in_region(region: str) -> List[str]:
     """Ищет города в регионе через API"""
     try:
-        async with aiohttp.ClientSession() as session:
-            # Используем GeoDB API для поиска городов по региону
-            url = f"http://geodb-free-service.wirefreethought.com/v1/geo/places?countryIds={region}&limit=20&languageCode=ru"
-            async with session.get(url, timeout=10) as response:
-                if response.status == 200:
-                    data = await response.json()
-                    cities = []
-                    if data.get("data"):
-                        for item in data["data"]:
-                            if "city" in item:
-                                cities.append(item["city"])
-                    return cities[:15]  # Ограничиваем 15 городами
+        session = get_http_session()
+        # Используем GeoDB API для поиска городов по региону
+        params = {"countryIds": region, "limit": 20, "languageCode": "ru"}
+        async with session.get(Config.GEODB_PLACES_URL, params=params, timeout=10) as response:
+            if response.status == 200:
+                data = json_loads(await response.read())
+                cities = []
+                if data.get("data"):
+                    for item in data["data"]:
+                        if "city" in item:
+                            cities.append(item["city"])
+                return cities[:15]  # Ограничиваем 15 городами
     except Exception as e:
-        logger.error(f"❌ Ошибка поиска городов в регионе {region}: {e}")
+        logger.error("❌ Ошибка поиска городов в регионе %s: %s", region, e)
     
     return []
 
+# Известные города по длине названия: опечатки ищем среди слов той же длины,
+# чтобы "Томск" не превратился в "Омск"
+known_cities_by_len: Dict[int, List[str]] = defaultdict(list)
+for _name in Config.KNOWN_CITIES:
+    known_cities_by_len[len(_name)].append(_name)
+
+def match_known_city_typo(city: str) -> Optional[str]:
+    """🔎 Находит известный город по названию с опечаткой (моксва -> москва)"""
+    if fuzzy_process is None or not city or not isinstance(city, str):
+        return None
+    
+    city_lower = city.lower().strip()
+    if (len(city_lower) < Config.FUZZY_MIN_LENGTH
+            or city_lower in Config.KNOWN_CITIES
+            or city_lower in Config.CITY_ALIASES):
+        return None
+    
+    candidates = known_cities_by_len.get(len(city_lower))
+    if not candidates:
+        return None
+    
+    matches = fuzzy_process.extract(
+        city_lower, candidates,
+        scorer=fuzz.ratio,
+        score_cutoff=Config.FUZZY_SCORE_CUTOFF,
+        limit=2
+    )
+    if not matches:
+        return None
+    # Два города одинаково похожи - не угадываем
+    if len(matches) > 1 and matches[1][1] == matches[0][1]:
+        return None
+    return matches[0][0]
+
+# Допустимые символы в названии города: буквы, пробелы, дефис и знаки препинания.
+# Цифры и "_" не пропускаем, и хотя бы одна буква обязательна
+city_name_pattern = re.compile(r"(?=.*[^\W\d_])(?:[^\W\d_]|[\s\-.,'’()])+")
+
+def is_valid_city_name(text: str) -> bool:
+    """✏️ Проверка ввода до обращения к API (эмодзи, мусор, слишком длинный текст)"""
+    return (
+        Config.CITY_NAME_MIN_LENGTH <= len(text) <= Config.CITY_NAME_MAX_LENGTH
+        and city_name_pattern.fullmatch(text) is not None
+    )
+
+# Все псевдонимы одной регуляркой (длинные первыми), вместо перебора в цикле.
+# Только целым словом: иначе "Пинск" находил "нск", а "Томск" - "мск"
+city_alias_pattern = re.compile(
+    r"(?<!\w)(?:"
+    + "|".join(re.escape(alias) for alias in sorted(Config.CITY_ALIASES, key=len, reverse=True))
+    + r")(?!\w)"
+)
+
+# Псевдонимы и известные города в одном словаре: точное совпадение - одна
+# проверка. Псевдонимы важнее ("лондон" -> "London")
+city_lookup: Dict[str, str] = {name: data[2] for name, data in Config.KNOWN_CITIES.items()}
+city_lookup.update(Config.CITY_ALIASES)
+
+# Результат зависит только от ввода, а пользователи вводят одни и те же города
+@lru_cache(maxsize=Config.CACHE_MAX_ENTRIES)
 def normalize_city(city: str) -> str:
     """Нормализация названия города"""
     if not city or not isinstance(city, str):
         return "Москва"
     
-    city_lower = city.lower().strip()
+    # Схлопываем повторные пробелы: "нижний  новгород" -> "нижний новгород"
+    city_lower = " ".join(city.lower().split())
     
-    # Проверяем псевдонимы
-    for alias, real_name in Config.CITY_ALIASES.items():
-        if city_lower == alias or alias in city_lower:
-            return real_name
+    # Псевдоним или известный город с каноническим написанием ("Ростов-на-Дону")
+    real_name = city_lookup.get(city_lower)
+    if real_name:
+        return real_name
     
-    # Убираем лишние пробелы и делаем первую букву заглавной
-    words = city.strip().split()
-    normalized_words = []
-    for word in words:
-        if word:
-            normalized_words.append(word.capitalize())
+    # Псевдоним отдельным словом внутри строки ("г. мск")
+    match = city_alias_pattern.search(city_lower)
+    if match:
+        return Config.CITY_ALIASES[match.group()]
     
-    return " ".join(normalized_words)
+    # Убираем лишние пробелы и делаем первую букву заглавной
+    return " ".join(word.capitalize() for word in city.split())
 
 def get_user_city(user_id: int) -> str:
     """Получение города пользователя"""
@@ -430,7 +906,19 @@ def set_user_city(user_id: int, city: str):
     if user_id not in user_sessions:
         user_sessions[user_id] = {}
     user_sessions[user_id]["city"] = normalized
-    save_data_to_file()  # Сохраняем изменения
+    mark_data_dirty()
+
+def reindex_notification(user_id: int):
+    """🔔 Обновляет индекс уведомлений по времени для пользователя"""
+    old_slot = notification_slots.pop(user_id, None)
+    if old_slot is not None:
+        notifications_by_time[old_slot].discard(user_id)
+    
+    # В индекс попадают только включенные уведомления с выбранным временем
+    notif_data = notifications.get(user_id)
+    if notif_data and notif_data.get("enabled") and notif_data.get("utc_time"):
+        notification_slots[user_id] = notif_data["utc_time"]
+        notifications_by_time[notif_data["utc_time"]].add(user_id)
 
 def update_notification_data(user_id: int, data: dict):
     """Обновляет данные уведомлений пользователя"""
@@ -438,150 +926,224 @@ def update_notification_data(user_id: int, data: dict):
         notifications[user_id] = {}
     
     notifications[user_id].update(data)
-    save_data_to_file()  # Сохраняем изменения
-    logger.info(f"💾 Обновлены уведомления для пользователя {user_id}: {data}")
+    reindex_notification(user_id)
+    mark_data_dirty()
+    logger.info("💾 Обновлены уведомления для пользователя %s: %s", user_id, data)
+
+# Формат коротких callback_data городов: "c" + 10 hex-символов хэша
+city_callback_pattern = re.compile(r"c[0-9a-f]{10}")
+
+def city_callback_data(city: str) -> str:
+    """🔢 Короткий callback_data для кнопки города"""
+    data = city_callbacks.get(city)
+    if data is None:
+        data = "c" + hashlib.blake2b(city.encode("utf-8"), digest_size=5).hexdigest()
+        city_callbacks[city] = data
+        callback_cities[data] = city
+    return data
 
 # ============= СЕРВИС ПОГОДЫ =============
+# Ограничение одновременных запросов к API погоды (лимиты Open-Meteo)
+api_semaphore = asyncio.Semaphore(Config.API_CONCURRENCY)
+
+@lru_cache(maxsize=Config.CACHE_MAX_ENTRIES)
+def forecast_url(lat: float, lon: float) -> URL:
+    """🔗 Готовый URL прогноза: параметры кодируются один раз на координаты"""
+    return URL(Config.OPEN_METEO_FORECAST_URL).with_query(
+        {**Config.OPEN_METEO_FORECAST_PARAMS, "latitude": lat, "longitude": lon}
+    )
+
+# Известные города запрашиваются чаще всего - собираем их URL сразу
+for _lat, _lon, _ in Config.KNOWN_CITIES.values():
+    forecast_url(_lat, _lon)
+
+async def fetch_forecast(lat: float, lon: float) -> Optional[Dict]:
+    """🌐 Запрос прогноза в Open-Meteo с повтором при 429"""
+    session = get_http_session()
+    url = forecast_url(lat, lon)
+    
+    for attempt in range(Config.MAX_RETRIES):
+        async with api_semaphore:
+            async with session.get(url) as response:
+                if response.status == 200:
+                    return json_loads(await response.read())
+                if response.status != 429:
+                    logger.error("❌ API погоды вернул статус %s", response.status)
+                    return None
+        
+        # 429: экспоненциальная пауза перед повтором
+        if attempt < Config.MAX_RETRIES - 1:
+            delay = Config.API_BACKOFF_BASE * 2 ** attempt
+            logger.warning("⏳ API погоды ограничил частоту запросов, повтор через %s сек", delay)
+            await asyncio.sleep(delay)
+    
+    logger.error("❌ API погоды ограничивает частоту запросов, попытки исчерпаны")
+    return None
+
+def get_cached_city(city_name: str) -> Optional[Tuple[float, float, str]]:
+    """🗺️ Координаты города без обращения к API (известные города и кэш)"""
+    known_city = get_known_city(city_name)
+    if known_city:
+        return known_city
+    return cache_get(city_cache, f"city_search_{normalize_city(city_name).lower()}")
+
+def forecast_cache_key(lat: float, lon: float) -> str:
+    """🔑 Ключ прогноза по координатам (~1 км), общий для всех написаний города"""
+    return f"forecast_{lat:.2f}_{lon:.2f}"
+
+def get_cached_weather(city: str) -> Optional[Dict]:
+    """💾 Прогноз из кэша, если он еще свежий (10 минут)"""
+    city_data = get_cached_city(city)
+    if not city_data:
+        return None
+    
+    lat, lon, city_name = city_data
+    weather = cache_get(weather_cache, forecast_cache_key(lat, lon))
+    if not weather:
+        return None
+    return {"city": city_name, "latitude": lat, "longitude": lon, **weather}
+
 async def get_weather_async(city: str) -> Optional[Dict]:
     """Получение прогноза погоды"""
     normalized_city = normalize_city(city)
-    cache_key = f"weather_{normalized_city}"
-    
-    # Проверяем кэш (15 минут)
-    if cache_key in weather_cache:
-        timestamp, data = weather_cache[cache_key]
-        if time.time() - timestamp < 900:  # 15 минут
-            return data
     
-    # Ищем координаты города
+    # Ищем координаты города (геокодирование кэшируется на 30 дней)
     city_data = await search_city_api(normalized_city)
     if not city_data:
-        logger.error(f"❌ Город не найден: {normalized_city}")
+        logger.error("❌ Город не найден: %s", normalized_city)
         return None
     
     lat, lon, city_name = city_data
     
+    # Прогноз кэшируется по координатам на 10 минут
+    cache_key = forecast_cache_key(lat, lon)
+    weather = cache_get(weather_cache, cache_key)
+    if not weather:
+        # Рассылка в одно время запрашивает один город для многих пользователей
+        weather = await single_flight(cache_key, lambda: load_forecast(lat, lon, city_name, cache_key))
+        if not weather:
+            # API недоступен - лучше недавний прогноз с пометкой, чем ошибка
+            stale_weather = cache_get(weather_cache, cache_key, allow_stale=True)
+            if not stale_weather:
+                return None
+            logger.warning("⚠️ Показываю прогноз из кэша для %s", city_name)
+            weather = {**stale_weather, "stale": True}
+    
+    return {"city": city_name, "latitude": lat, "longitude": lon, **weather}
+
+async def load_forecast(lat: float, lon: float, city_name: str, cache_key: str) -> Optional[Dict]:
+    """🌤️ Загрузка прогноза из API и запись в кэш"""
     try:
-        async with aiohttp.ClientSession() as session:
-            # Получаем погоду через Open-Meteo API
-            weather_url = "https://api.open-meteo.com/v1/forecast"
-            params = {
-                "latitude": lat,
-                "longitude": lon,
-                "current": ["temperature_2m", "relative_humidity_2m", "apparent_temperature", 
-                           "precipitation", "rain", "showers", "snowfall", "weather_code", 
-                           "cloud_cover", "wind_speed_10m", "wind_direction_10m"],
-                "daily": ["temperature_2m_max", "temperature_2m_min", 
-                         "precipitation_sum", "rain_sum", "showers_sum", 
-                         "snowfall_sum", "wind_speed_10m_max", 
-                         "wind_gusts_10m_max", "wind_direction_10m_dominant",
-                         "weather_code", "sunrise", "sunset", "daylight_duration"],
-                "hourly": ["temperature_2m", "relative_humidity_2m", "precipitation_probability"],
-                "timezone": "auto",
-                "forecast_days": 3
-            }
-            
-            async with session.get(weather_url, params=params, timeout=10) as response:
-                if response.status == 200:
-                    weather_data = await response.json()
-                    
-                    forecast = {
-                        "city": city_name,
-                        "latitude": lat,
-                        "longitude": lon,
-                        "current": weather_data.get("current", {}),
-                        "daily": weather_data.get("daily", {}),
-                        "hourly": weather_data.get("hourly", {})
-                    }
-                    
-                    # Сохраняем в кэш
-                    weather_cache[cache_key] = (time.time(), forecast)
-                    return forecast
-                else:
-                    logger.error(f"❌ API погоды вернул статус {response.status}")
-    
+        # ⏱️ Общий бюджет на запрос прогноза (вместе с повторами)
+        async with asyncio.timeout(Config.FETCH_TIMEOUT):
+            weather_data = await fetch_forecast(lat, lon)
+    except asyncio.TimeoutError:
+        logger.warning("⏰ Таймаут получения погоды для %s (%s сек)", city_name, Config.FETCH_TIMEOUT)
+        return None
     except Exception as e:
-        logger.error(f"❌ Ошибка получения погоды для {city_name}: {e}")
+        logger.error("❌ Ошибка получения погоды для %s: %s", city_name, e)
+        return None
     
-    return None
+    if not weather_data:
+        return None
+    
+    weather = {
+        "current": weather_data.get("current", {}),
+        "daily": weather_data.get("daily", {}),
+        "hourly": weather_data.get("hourly", {}),
+        "updated_at": datetime.now().strftime('%d.%m.%Y %H:%M')
+    }
+    cache_put(weather_cache, cache_key, weather, Config.WEATHER_CACHE_TTL, Config.WEATHER_STALE_TTL)
+    return weather
+
+# ✨ Эмодзи и описание по коду погоды WMO (Open-Meteo): одна проверка на код
+WEATHER_CODES = {
+    0: ("☀️", "Ясно и солнечно ☀️"),
+    1: ("🌤️", "Преимущественно ясно 🌤️"),
+    2: ("⛅", "Переменная облачность ⛅"),
+    3: ("☁️", "Пасмурно ☁️"),
+    45: ("🌫️", "Туманно 🌫️"),
+    48: ("🌫️", "Туман с инеем ❄️"),
+    51: ("🌦️", "Легкая морось 🌦️"),
+    53: ("🌦️", "Умеренная морось 🌧️"),
+    55: ("🌦️", "Сильная морось 🌧️"),
+    61: ("🌧️", "Небольшой дождь 🌧️"),
+    63: ("🌧️", "Умеренный дождь 🌧️"),
+    65: ("🌧️", "Сильный дождь 🌧️"),
+    71: ("❄️", "Небольшой снег ❄️"),
+    73: ("❄️", "Умеренный снег ❄️"),
+    75: ("❄️", "Сильный снег ❄️"),
+    77: ("🌨️", "Град 🌨️"),
+    80: ("⛈️", "Кратковременный дождь ⛈️"),
+    81: ("⛈️", "Умеренный ливень ⛈️"),
+    82: ("⛈️", "Сильный ливень ⛈️"),
+    85: ("🌨️", "Небольшой снегопад 🌨️"),
+    86: ("🌨️", "Сильный снегопад 🌨️"),
+    95: ("⛈️", "Гроза ⛈️"),
+    96: ("⛈️", "Гроза с градом ⛈️"),
+    99: ("⛈️", "Сильная гроза ⛈️")
+}
+UNKNOWN_WEATHER = ("🌤️", "Неизвестно 🌤️")
 
 def get_weather_emoji(weather_code: int) -> str:
     """✨ Красивые эмодзи для погоды"""
-    if weather_code == 0:
-        return "☀️"  # Ясно
-    elif weather_code == 1:
-        return "🌤️"  # Преимущественно ясно
-    elif weather_code == 2:
-        return "⛅"  # Переменная облачность
-    elif weather_code == 3:
-        return "☁️"  # Пасмурно
-    elif weather_code in [45, 48]:
-        return "🌫️"  # Туман
-    elif weather_code in [51, 53, 55]:
-        return "🌦️"  # Морось
-    elif weather_code in [61, 63, 65]:
-        return "🌧️"  # Дождь
-    elif weather_code in [71, 73, 75]:
-        return "❄️"  # Снег
-    elif weather_code in [77]:
-        return "🌨️"  # Град
-    elif weather_code in [80, 81, 82]:
-        return "⛈️"  # Ливень
-    elif weather_code in [85, 86]:
-        return "🌨️"  # Снегопад
-    elif weather_code in [95, 96, 99]:
-        return "⛈️"  # Гроза
-    else:
-        return "🌤️"
+    return WEATHER_CODES.get(weather_code, UNKNOWN_WEATHER)[0]
+
+# 🌡️ Пороги шкал по возрастанию и эмодзи для каждого интервала:
+# индекс интервала находит bisect вместо цепочки if/elif
+TEMPERATURE_THRESHOLDS = (-10, 0, 5, 10, 15, 20, 25, 30)
+TEMPERATURE_EMOJI = ("🧊", "🥶", "❄️", "🧥", "😐", "😊", "☀️", "🥵", "🔥")
+
+WIND_SPEED_THRESHOLDS = (0.5, 3.3, 5.5, 7.9, 10.7, 13.8)
+WIND_SPEED_EMOJI = (
+    "🍃",  # Штиль
+    "💨",  # Легкий ветер
+    "🌬️",  # Слабый ветер
+    "💨💨",  # Умеренный ветер
+    "💨💨💨",  # Свежий ветер
+    "🌪️",  # Сильный ветер
+    "🌀"  # Очень сильный ветер
+)
+
+PRECIP_THRESHOLDS = (5, 10)
+PRECIP_EMOJI = ("🌧️", "🌨️", "⛈️")
+
+WIND_DIRECTIONS = ("⬇️ С", "↙️ СВ", "⬅️ В", "↖️ ЮВ", "⬆️ Ю", "↗️ ЮЗ", "➡️ З", "↘️ СЗ")
 
 def get_temperature_emoji(temp: float) -> str:
     """🌡️ Эмодзи для температуры"""
-    if temp > 30:
-        return "🔥"
-    elif temp > 25:
-        return "🥵"
-    elif temp > 20:
-        return "☀️"
-    elif temp > 15:
-        return "😊"
-    elif temp > 10:
-        return "😐"
-    elif temp > 5:
-        return "🧥"
-    elif temp > 0:
-        return "❄️"
-    elif temp > -10:
-        return "🥶"
-    else:
-        return "🧊"
+    # Граница относится к нижнему интервалу: ровно 30° - еще не "🔥"
+    return TEMPERATURE_EMOJI[bisect_left(TEMPERATURE_THRESHOLDS, temp)]
 
 def get_wind_speed_emoji(wind_speed: float) -> str:
     """💨 Эмодзи для скорости ветра"""
-    if wind_speed < 0.5:
-        return "🍃"  # Штиль
-    elif wind_speed < 3.3:
-        return "💨"  # Легкий ветер
-    elif wind_speed < 5.5:
-        return "🌬️"  # Слабый ветер
-    elif wind_speed < 7.9:
-        return "💨💨"  # Умеренный ветер
-    elif wind_speed < 10.7:
-        return "💨💨💨"  # Свежий ветер
-    elif wind_speed < 13.8:
-        return "🌪️"  # Сильный ветер
-    else:
-        return "🌀"  # Очень сильный ветер
+    # Граница относится к верхнему интервалу: ровно 0.5 м/с - уже не штиль
+    return WIND_SPEED_EMOJI[bisect_right(WIND_SPEED_THRESHOLDS, wind_speed)]
+
+def get_precip_emoji(precip: float) -> str:
+    """🌧️ Эмодзи для количества осадков"""
+    return PRECIP_EMOJI[bisect_right(PRECIP_THRESHOLDS, precip)]
 
 def get_wind_direction(direction: float) -> str:
     """🧭 Направление ветра"""
-    directions = ["⬇️ С", "↙️ СВ", "⬅️ В", "↖️ ЮВ", "⬆️ Ю", "↗️ ЮЗ", "➡️ З", "↘️ СЗ"]
-    idx = round(direction / 45) % 8
-    return directions[idx]
+    return WIND_DIRECTIONS[round(direction / 45) % 8]
+
+def format_forecast_day(date_str: str, weather_code: int, min_temp: float, max_temp: float) -> str:
+    """📅 Строка прогноза на один день"""
+    # Open-Meteo отдает даты строго как YYYY-MM-DD
+    year, month, day = int(date_str[:4]), int(date_str[5:7]), int(date_str[8:10])
+    return DAY_FORECAST_TEMPLATE.format(
+        emoji=get_weather_emoji(weather_code),
+        day=WEEKDAYS[datetime(year, month, day).weekday()],
+        date=f"{day:02d}.{month:02d}",
+        min_temp=min_temp,
+        max_temp=max_temp
+    )
 
-def format_weather_daily(forecast: Dict) -> str:
-    """✨ Красивое форматирование погоды"""
+def format_weather_daily(forecast: Dict) -> Optional[str]:
+    """✨ Красивое форматирование погоды (None, если данные битые)"""
     if not forecast:
-        return "❌ Не удалось получить прогноз погоды"
+        return None
     
     city = forecast.get("city", "Неизвестный город")
     current = forecast.get("current", {})
@@ -607,106 +1169,106 @@ def format_weather_daily(forecast: Dict) -> str:
         sunrise = daily.get("sunrise", [])
         sunset = daily.get("sunset", [])
         
-        # Эмодзи
-        weather_emoji = get_weather_emoji(weather_code)
-        temp_emoji = get_temperature_emoji(temp)
-        wind_emoji = get_wind_speed_emoji(wind_speed)
-        wind_dir = get_wind_direction(wind_direction)
-        
-        # 🎨 Форматируем красиво
-        lines = []
-        lines.append(f"✨ <b>{weather_emoji} Погода в {city}</b> ✨")
-        lines.append("══════════════════════════════════")
-        
-        # 🌡️ Текущая температура
-        lines.append(f"{temp_emoji} <b>Температура:</b> <code>{temp:.1f}°C</code>")
+        # 🌡️ Ощущается как
+        feels_like_line = ""
         if abs(feels_like - temp) > 1:
-            lines.append(f"🌡️ <b>Ощущается как:</b> <code>{feels_like:.1f}°C</code>")
-        
-        # 💨 Ветер
-        lines.append(f"{wind_emoji} <b>Ветер:</b> <code>{wind_speed:.1f} м/с</code> {wind_dir}")
-        
-        # 💧 Влажность
-        lines.append(f"💧 <b>Влажность:</b> <code>{humidity:.0f}%</code>")
-        
-        # ☁️ Облачность
-        lines.append(f"☁️ <b>Облачность:</b> <code>{cloud_cover:.0f}%</code>")
+            feels_like_line = FEELS_LIKE_TEMPLATE.format(feels_like)
         
         # 💧 Осадки
+        precip_line = ""
         if precip and precip[0] > 0:
-            rain_emoji = "🌧️" if precip[0] < 5 else "🌨️" if precip[0] < 10 else "⛈️"
-            lines.append(f"{rain_emoji} <b>Осадки сегодня:</b> <code>{precip[0]:.1f} мм</code>")
+            precip_line = PRECIP_TEMPLATE.format(get_precip_emoji(precip[0]), precip[0])
         
         # 🌅 Восход и закат
+        sun_lines = ""
         if sunrise and sunset:
             try:
-                sunrise_time = sunrise[0].split("T")[1][:5]
-                sunset_time = sunset[0].split("T")[1][:5]
-                lines.append(f"🌅 <b>Восход:</b> <code>{sunrise_time}</code>")
-                lines.append(f"🌇 <b>Закат:</b> <code>{sunset_time}</code>")
-            except:
+                sun_lines = SUN_TEMPLATE.format(
+                    sunrise[0].split("T")[1][:5],
+                    sunset[0].split("T")[1][:5]
+                )
+            except IndexError:
                 pass
         
-        # 📝 Описание
-        descriptions = {
-            0: "Ясно и солнечно ☀️",
-            1: "Преимущественно ясно 🌤️",
-            2: "Переменная облачность ⛅",
-            3: "Пасмурно ☁️",
-            45: "Туманно 🌫️",
-            48: "Туман с инеем ❄️",
-            51: "Легкая морось 🌦️",
-            53: "Умеренная морось 🌧️",
-            55: "Сильная морось 🌧️",
-            61: "Небольшой дождь 🌧️",
-            63: "Умеренный дождь 🌧️",
-            65: "Сильный дождь 🌧️",
-            71: "Небольшой снег ❄️",
-            73: "Умеренный снег ❄️",
-            75: "Сильный снег ❄️",
-            77: "Град 🌨️",
-            80: "Кратковременный дождь ⛈️",
-            81: "Умеренный ливень ⛈️",
-            82: "Сильный ливень ⛈️",
-            85: "Небольшой снегопад 🌨️",
-            86: "Сильный снегопад 🌨️",
-            95: "Гроза ⛈️",
-            96: "Гроза с градом ⛈️",
-            99: "Сильная гроза ⛈️"
-        }
-        
-        desc = descriptions.get(weather_code, "Неизвестно 🌤️")
-        lines.append(f"📝 <b>Описание:</b> {desc}")
-        
         # 📅 Прогноз на 3 дня
-        if len(dates) >= 3 and len(temps_max) >= 3 and len(temps_min) >= 3:
-            lines.append("")
-            lines.append("📅 <b>Прогноз на 3 дня:</b>")
-            for i in range(min(3, len(dates))):
-                try:
-                    date_str = dates[i]
-                    date_obj = datetime.fromisoformat(date_str.replace('Z', '+00:00'))
-                    day_name = ["Пн", "Вт", "Ср", "Чт", "Пт", "Сб", "Вс"][date_obj.weekday()]
-                    date_formatted = date_obj.strftime("%d.%m")
-                    
-                    day_weather_emoji = get_weather_emoji(weather_codes[i] if i < len(weather_codes) else 0)
-                    max_temp = temps_max[i] if i < len(temps_max) else 0
-                    min_temp = temps_min[i] if i < len(temps_min) else 0
-                    
-                    lines.append(f"  {day_weather_emoji} <b>{day_name} {date_formatted}:</b> <code>{min_temp:.0f}°...{max_temp:.0f}°</code>")
-                except:
-                    pass
+        days_block = ""
+        # Дни без температуры (null от API) пропускаем, а не роняем всю карточку
+        valid_days = [
+            i for i in range(min(len(dates), len(temps_max), len(temps_min)))
+            if dates[i] and temps_min[i] is not None and temps_max[i] is not None
+        ][:3]
+        if valid_days:
+            days_block = DAYS_HEADERS[len(valid_days)] + "".join(
+                format_forecast_day(
+                    dates[i],
+                    weather_codes[i] if i < len(weather_codes) and weather_codes[i] is not None else 0,
+                    temps_min[i],
+                    temps_max[i]
+                ) + "\n"
+                for i in valid_days
+            )
         
-        lines.append("══════════════════════════════════")
-        lines.append(f"🕐 <i>Обновлено: {datetime.now().strftime('%d.%m.%Y %H:%M')}</i>")
+        weather_emoji, description = WEATHER_CODES.get(weather_code, UNKNOWN_WEATHER)
         
-        return "\n".join(lines)
+        # 🎨 Форматируем красиво
+        return WEATHER_TEMPLATE.format(
+            weather_emoji=weather_emoji,
+            city=city,
+            temp_emoji=get_temperature_emoji(temp),
+            temp=temp,
+            feels_like_line=feels_like_line,
+            wind_emoji=get_wind_speed_emoji(wind_speed),
+            wind_speed=wind_speed,
+            wind_dir=get_wind_direction(wind_direction),
+            humidity=humidity,
+            cloud_cover=cloud_cover,
+            precip_line=precip_line,
+            sun_lines=sun_lines,
+            description=description,
+            days_block=days_block,
+            # Время получения прогноза, а не отображения (прогноз может быть из кэша)
+            updated_at=forecast.get("updated_at") or datetime.now().strftime('%d.%m.%Y %H:%M'),
+            stale_line=STALE_NOTE if forecast.get("stale") else ""
+        )
         
     except Exception as e:
-        logger.error(f"❌ Ошибка форматирования: {e}")
-        return f"❌ Ошибка обработки данных о погоде: {str(e)}"
+        logger.error("❌ Ошибка форматирования: %s", e)
+        return None
+
+async def get_weather_text(city: str) -> Optional[str]:
+    """📝 Готовый текст погоды для города"""
+    # Текст зависит только от города: при частых нажатиях и рассылке
+    # одному городу прогноз запрашивается и форматируется один раз
+    formatted = cache_get(rendered_weather, city)
+    if formatted is None:
+        formatted = await single_flight(f"render_{city}", lambda: render_weather(city))
+    return formatted
+
+async def render_weather(city: str) -> Optional[str]:
+    """🎨 Запрашивает прогноз и сохраняет отформатированный текст"""
+    forecast = await get_weather_async(city)
+    if not forecast:
+        return None
+    formatted = format_weather_daily(forecast)
+    # Ошибку форматирования не кэшируем, следующий запрос попробует снова
+    if formatted:
+        cache_put(rendered_weather, city, formatted, Config.RENDER_CACHE_TTL)
+    return formatted
 
 # ============= КРАСИВЫЕ КЛАВИАТУРЫ =============
+# Кнопки, которые повторяются в разных клавиатурах, создаем один раз
+BACK_TO_MENU_BUTTON = InlineKeyboardButton("↩️ Назад в меню", callback_data="back_main")
+HOME_BUTTON = InlineKeyboardButton("🏠 Главное меню", callback_data="back_main")
+CITIES_FOOTER_ROW = [
+    InlineKeyboardButton("🔍 Найти другой", callback_data="find_city"),
+    InlineKeyboardButton("↩️ Назад", callback_data="back_main")
+]
+
+@lru_cache(maxsize=Config.CACHE_MAX_ENTRIES)
+def city_button(city: str) -> InlineKeyboardButton:
+    """🏙️ Кнопка города (одна на город для всех клавиатур)"""
+    return InlineKeyboardButton(city, callback_data=city_callback_data(city))
+
 def get_main_menu_keyboard() -> InlineKeyboardMarkup:
     """✨ Главное меню с красивыми эмодзи"""
     keyboard = [
@@ -733,24 +1295,16 @@ def get_regions_keyboard() -> InlineKeyboardMarkup:
         if row:
             keyboard.append(row)
     
-    keyboard.append([InlineKeyboardButton("↩️ Назад в меню", callback_data="back_main")])
+    keyboard.append([BACK_TO_MENU_BUTTON])
     
     return InlineKeyboardMarkup(keyboard)
 
-def get_cities_keyboard(cities: List[str]) -> InlineKeyboardMarkup:
+# Города региона обычно одни и те же - готовую клавиатуру переиспользуем
+@lru_cache(maxsize=64)
+def get_cities_keyboard(cities: Tuple[str, ...]) -> InlineKeyboardMarkup:
     """🏙️ Клавиатура с найденными городами"""
-    keyboard = []
-    
-    for i in range(0, len(cities), 3):
-        row = []
-        for city in cities[i:i+3]:
-            row.append(InlineKeyboardButton(city, callback_data=f"city_{city}"))
-        keyboard.append(row)
-    
-    keyboard.append([
-        InlineKeyboardButton("🔍 Найти другой", callback_data="find_city"),
-        InlineKeyboardButton("↩️ Назад", callback_data="back_main")
-    ])
+    keyboard = [[city_button(city) for city in cities[i:i+3]] for i in range(0, len(cities), 3)]
+    keyboard.append(CITIES_FOOTER_ROW)
     
     return InlineKeyboardMarkup(keyboard)
 
@@ -770,7 +1324,7 @@ def get_notification_keyboard(user_id: int) -> InlineKeyboardMarkup:
         [InlineKeyboardButton(f"🔔 Статус: {status}", callback_data="notif_toggle")],
         [InlineKeyboardButton("📊 Информация", callback_data="notif_info")],
         [InlineKeyboardButton("🗑️ Удалить настройки", callback_data="notif_delete")],
-        [InlineKeyboardButton("↩️ Назад в меню", callback_data="back_main")]
+        [BACK_TO_MENU_BUTTON]
     ]
     
     return InlineKeyboardMarkup(keyboard)
@@ -795,21 +1349,80 @@ def get_time_selection_keyboard() -> InlineKeyboardMarkup:
 
 def get_quick_cities_keyboard() -> InlineKeyboardMarkup:
     """🏙️ Быстрый выбор популярных городов"""
-    popular_cities = ["Москва", "Санкт-Петербург", "Новосибирск", "Екатеринбург", 
-                      "Казань", "Нижний Новгород", "Йошкар-Ола", "Киев", "Минск"]
-    
-    keyboard = []
-    for i in range(0, len(popular_cities), 3):
-        row = []
-        for city in popular_cities[i:i+3]:
-            row.append(InlineKeyboardButton(city, callback_data=f"city_{city}"))
-        keyboard.append(row)
+    popular_cities = Config.POPULAR_CITIES
     
+    keyboard = [[city_button(city) for city in popular_cities[i:i+3]] for i in range(0, len(popular_cities), 3)]
     keyboard.append([InlineKeyboardButton("🔍 Другой город...", callback_data="find_city")])
     
     return InlineKeyboardMarkup(keyboard)
 
+# Статичные клавиатуры не меняются - строим их один раз при запуске.
+# Для популярных городов заодно регистрируются callback_data,
+# и кнопки работают после перезапуска
+MAIN_MENU_KEYBOARD = get_main_menu_keyboard()
+REGIONS_KEYBOARD = get_regions_keyboard()
+TIME_SELECTION_KEYBOARD = get_time_selection_keyboard()
+QUICK_CITIES_KEYBOARD = get_quick_cities_keyboard()
+
+HELP_KEYBOARD = InlineKeyboardMarkup([
+    [HOME_BUTTON],
+    [InlineKeyboardButton("🌤️ Популярные города", callback_data="quick_cities")]
+])
+
+# Под прогнозом погоды
+WEATHER_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔄 Обновить", callback_data="weather_now")],
+    [InlineKeyboardButton("📍 Сменить город", callback_data="find_city")],
+    [InlineKeyboardButton("⏰ Настроить уведомления", callback_data="notifications")],
+    [HOME_BUTTON]
+])
+SEARCH_RESULT_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("📍 Сменить город", callback_data="find_city")],
+    [InlineKeyboardButton("⏰ Настроить уведомления", callback_data="notifications")],
+    [HOME_BUTTON]
+])
+
+# Когда город или погода не найдены
+WEATHER_NOT_FOUND_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔍 Найти другой город", callback_data="find_city")],
+    [InlineKeyboardButton("🌍 Поиск по регионам", callback_data="regions")],
+    [HOME_BUTTON]
+])
+CITY_NOT_FOUND_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔍 Попробовать снова", callback_data="find_city")],
+    [InlineKeyboardButton("🌍 Поиск по регионам", callback_data="regions")],
+    [HOME_BUTTON]
+])
+REGION_NOT_FOUND_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔍 Найти город", callback_data="find_city")],
+    [HOME_BUTTON]
+])
+NOTIF_CITY_NOT_FOUND_KEYBOARD = InlineKeyboardMarkup([
+    [InlineKeyboardButton("🔍 Попробовать снова", callback_data="notif_city")],
+    [InlineKeyboardButton("⏰ Назад к уведомлениям", callback_data="notifications")]
+])
+
 # ============= ОБРАБОТЧИКИ =============
+async def edit_message(message: Message, text: str, reply_markup: Optional[InlineKeyboardMarkup] = None):
+    """✏️ Редактирование сообщения без повторной отправки того же содержимого"""
+    key = (message.chat_id, message.message_id)
+    signature = hash((text, reply_markup))
+    
+    # Telegram все равно ответит "message is not modified" - не тратим запрос
+    if rendered_messages.get(key) == signature:
+        return
+    
+    try:
+        await message.edit_text(text, reply_markup=reply_markup, parse_mode=ParseMode.HTML)
+    except BadRequest as e:
+        if "not modified" not in str(e).lower():
+            raise
+    
+    rendered_messages.pop(key, None)
+    while len(rendered_messages) >= Config.RENDERED_MESSAGES_MAX:
+        del rendered_messages[next(iter(rendered_messages))]
+    rendered_messages[key] = signature
+
 async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """✨ Команда /start с красивым приветствием"""
     user = update.effective_user
@@ -820,65 +1433,26 @@ async def start(update: Update, context: ContextTypes.DEFAULT_TYPE):
         user_sessions[user_id] = {"city": "Москва"}
     
     # 🎨 Красивое приветствие
-    welcome_text = (
-        f"✨ <b>Добро пожаловать, {user.first_name}!</b> ✨\n\n"
-        f"🌤️ <b>Weather Bot</b> - умный поиск погоды\n\n"
-        f"<i>Что я умею:</i>\n"
-        f"• 🔍 Находить <b>любой город</b> через API\n"
-        f"• 🌍 Искать по <b>регионам</b> по всему миру\n"
-        f"• 🌤️ Показывать <b>детальный прогноз</b> на 3 дня\n"
-        f"• ⏰ Отправлять <b>уведомления</b>\n"
-        f"• 💾 <b>Сохранять настройки</b> между перезапусками\n\n"
-        f"<b>Попробуйте ввести название города или выберите действие:</b>"
-    )
+    welcome_text = WELCOME_TEMPLATE.format(name=html.escape(user.first_name))
     
     await update.message.reply_text(
         welcome_text,
-        reply_markup=get_main_menu_keyboard(),
+        reply_markup=MAIN_MENU_KEYBOARD,
         parse_mode=ParseMode.HTML
     )
 
 async def help_command(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """ℹ️ Команда помощи"""
-    help_text = (
-        "ℹ️ <b>Справка по Weather Bot</b>\n\n"
-        "🔍 <b>Поиск города:</b>\n"
-        "• Введите название города на русском или английском\n"
-        "• Используйте псевдонимы (йошкар дыра, спб, питер)\n"
-        "• Ищите по регионам через меню\n\n"
-        "⏰ <b>Уведомления:</b>\n"
-        "• Выберите город для уведомлений\n"
-        "• Укажите время в формате UTC\n"
-        "• Включите/выключите уведомления\n"
-        "• Все настройки сохраняются автоматически\n\n"
-        "🌤️ <b>Что показывает прогноз:</b>\n"
-        "• Текущую температуру и ощущаемую\n"
-        "• Скорость и направление ветра\n"
-        "• Влажность и облачность\n"
-        "• Восход и закат солнца\n"
-        "• Прогноз на 3 дня вперед\n\n"
-        "💾 <b>Автосохранение:</b>\n"
-        "• Все ваши настройки сохраняются каждые 5 минут\n"
-        "• Данные сохраняются между перезапусками бота\n"
-        "• Вы можете удалить настройки в любое время\n\n"
-        "<i>Начните с команды /start или введите название города!</i>"
-    )
-    
-    keyboard = [
-        [InlineKeyboardButton("🏠 Главное меню", callback_data="back_main")],
-        [InlineKeyboardButton("🌤️ Популярные города", callback_data="quick_cities")]
-    ]
-    
     if update.callback_query:
-        await update.callback_query.edit_message_text(
-            help_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.HTML
+        await edit_message(
+            update.callback_query.message,
+            HELP_TEXT,
+            reply_markup=HELP_KEYBOARD
         )
     else:
         await update.message.reply_text(
-            help_text,
-            reply_markup=InlineKeyboardMarkup(keyboard),
+            HELP_TEXT,
+            reply_markup=HELP_KEYBOARD,
             parse_mode=ParseMode.HTML
         )
 
@@ -900,75 +1474,80 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     
     # 🏙️ Быстрый выбор городов
     elif action == "quick_cities":
-        await query.edit_message_text(
-            "🏙️ <b>Популярные города:</b>\n\n"
-            "<i>Выберите город из списка или найдите другой</i>",
-            reply_markup=get_quick_cities_keyboard(),
-            parse_mode=ParseMode.HTML
+        await edit_message(
+            query.message,
+            QUICK_CITIES_TEXT,
+            reply_markup=QUICK_CITIES_KEYBOARD
         )
     
     # 🌤️ Погода сейчас
     elif action == "weather_now":
         city = get_user_city(user_id)
-        await get_weather_for_user(query, user_id, city)
+        # Запрос к API идет в отдельной задаче, чтобы не задерживать
+        # обработку обновлений от других пользователей
+        context.application.create_task(
+            get_weather_for_user(query, user_id, city),
+            update=update
+        )
     
     # 🔍 Найти город
     elif action == "find_city":
-        await query.edit_message_text(
-            "🔍 <b>Введите название города:</b>\n\n"
-            "<i>Я найду любой город через API!</i>\n"
-            "<i>Примеры: Москва, Йошкар-Ола, Лондон, Нью-Йорк</i>\n"
-            "<i>Псевдонимы: йошкар дыра, спб, питер, нск</i>",
-            parse_mode=ParseMode.HTML
+        await edit_message(
+            query.message,
+            FIND_CITY_TEXT
         )
     
     # 🌍 Поиск по регионам
     elif action == "regions":
-        await query.edit_message_text(
-            "🌍 <b>Выберите регион:</b>\n\n"
-            "<i>Я найду города в выбранном регионе</i>",
-            reply_markup=get_regions_keyboard(),
-            parse_mode=ParseMode.HTML
+        await edit_message(
+            query.message,
+            REGIONS_TEXT,
+            reply_markup=REGIONS_KEYBOARD
         )
     
     # 🏙️ Выбор региона
     elif action.startswith("region_"):
         region = action[7:]
-        await query.edit_message_text(
-            f"🔍 <b>Ищу города в {region}...</b>",
-            parse_mode=ParseMode.HTML
+        await edit_message(
+            query.message,
+            f"🔍 <b>Ищу города в {region}...</b>"
         )
         
         cities = await search_cities_in_region(region)
         
         if cities:
-            await query.edit_message_text(
+            await edit_message(
+                query.message,
                 f"🏙️ <b>Найденные города в {region}:</b>\n\n"
                 f"<i>Выберите город:</i>",
-                reply_markup=get_cities_keyboard(cities),
-                parse_mode=ParseMode.HTML
+                reply_markup=get_cities_keyboard(tuple(cities))
             )
         else:
-            await query.edit_message_text(
+            await edit_message(
+                query.message,
                 f"❌ <b>Не удалось найти города в {region}</b>\n\n"
                 f"<i>Попробуйте ввести город вручную</i>",
-                reply_markup=InlineKeyboardMarkup([
-                    [InlineKeyboardButton("🔍 Найти город", callback_data="find_city")],
-                    [InlineKeyboardButton("🏠 Главное меню", callback_data="back_main")]
-                ]),
-                parse_mode=ParseMode.HTML
+                reply_markup=REGION_NOT_FOUND_KEYBOARD
             )
     
-    # 🏙️ Выбор конкретного города
-    elif action.startswith("city_"):
-        city = action[5:]  # Убираем "city_"
+    # 🏙️ Выбор конкретного города (city_* - кнопки старого формата)
+    elif action in callback_cities or action.startswith("city_"):
+        city = callback_cities.get(action) or action[5:]
         set_user_city(user_id, city)
         
-        await query.edit_message_text(
+        await edit_message(
+            query.message,
             f"✅ <b>Город установлен:</b> {city}\n\n"
             f"<i>Что дальше?</i>",
-            reply_markup=get_main_menu_keyboard(),
-            parse_mode=ParseMode.HTML
+            reply_markup=MAIN_MENU_KEYBOARD
+        )
+    
+    # ⚠️ Кнопка города из списка, созданного до перезапуска
+    elif city_callback_pattern.fullmatch(action):
+        await edit_message(
+            query.message,
+            STALE_BUTTON_TEXT,
+            reply_markup=MAIN_MENU_KEYBOARD
         )
     
     # ⏰ Уведомления
@@ -996,40 +1575,27 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 f"💾 <b>Сохранено:</b> {datetime.now().strftime('%d.%m.%Y %H:%M')}"
             )
         else:
-            info_text = (
-                "📊 <b>Информация об уведомлениях</b>\n\n"
-                "❌ <b>Уведомления не настроены</b>\n\n"
-                "<i>Для настройки уведомлений:</i>\n"
-                "1. Выберите город\n"
-                "2. Укажите время (UTC)\n"
-                "3. Включите уведомления\n\n"
-                "<i>Все настройки будут автоматически сохранены.</i>"
-            )
+            info_text = NOTIF_INFO_EMPTY_TEXT
         
-        await query.edit_message_text(
+        await edit_message(
+            query.message,
             info_text,
-            reply_markup=get_notification_keyboard(user_id),
-            parse_mode=ParseMode.HTML
+            reply_markup=get_notification_keyboard(user_id)
         )
     
     # 📍 Выбор города для уведомлений
     elif action == "notif_city":
-        await query.edit_message_text(
-            "📍 <b>Введите город для уведомлений:</b>\n\n"
-            "<i>Пример: Москва, Йошкар-Ола, Лондон</i>\n"
-            "<i>Можно использовать псевдонимы</i>",
-            parse_mode=ParseMode.HTML
+        await edit_message(
+            query.message,
+            NOTIF_CITY_TEXT
         )
     
     # ⏰ Выбор времени для уведомлений
     elif action == "notif_time":
-        await query.edit_message_text(
-            "⏰ <b>Выберите время уведомления (UTC):</b>\n\n"
-            "<i>Бот работает по времени UTC.</i>\n"
-            "<i>Пример для Москвы (UTC+3):</i>\n"
-            "<i>Если хотите получать в 9:00 по Москве, выберите 6:00 UTC</i>",
-            reply_markup=get_time_selection_keyboard(),
-            parse_mode=ParseMode.HTML
+        await edit_message(
+            query.message,
+            NOTIF_TIME_TEXT,
+            reply_markup=TIME_SELECTION_KEYBOARD
         )
     
     # 🕐 Выбор конкретного времени
@@ -1041,15 +1607,15 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         
         city = notifications[user_id].get("city", "Не выбран")
         
-        await query.edit_message_text(
+        await edit_message(
+            query.message,
             f"✅ <b>Время уведомления установлено:</b> {time_slot} UTC\n\n"
             f"<i>Не забудьте:</i>\n"
             f"1. 📍 Выбрать город: {city}\n"
             f"2. 🔔 Включить уведомления\n\n"
             f"💾 <b>Настройки сохранены!</b>\n"
             f"<i>Бот пришлет прогноз завтра в это время.</i>",
-            reply_markup=get_notification_keyboard(user_id),
-            parse_mode=ParseMode.HTML
+            reply_markup=get_notification_keyboard(user_id)
         )
     
     # 🔔 Включение/выключение уведомлений
@@ -1058,9 +1624,9 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             notifications[user_id] = {"enabled": True}
         else:
             notifications[user_id]["enabled"] = not notifications[user_id].get("enabled", False)
+        reindex_notification(user_id)
         
-        # Сохраняем изменения
-        save_data_to_file()
+        mark_data_dirty()
         
         status = "включены ✅" if notifications[user_id]["enabled"] else "выключены ❌"
         await query.answer(f"🔔 Уведомления {status}")
@@ -1070,17 +1636,17 @@ async def button_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     elif action == "notif_delete":
         if user_id in notifications:
             del notifications[user_id]
-            save_data_to_file()
+            reindex_notification(user_id)
+            mark_data_dirty()
         await query.answer("🗑️ Настройки удалены")
         await show_main_menu(query)
 
 async def show_main_menu(query):
     """🏠 Показать главное меню"""
-    await query.edit_message_text(
-        "🌤️ <b>Главное меню</b>\n\n"
-        "<i>Выберите действие:</i>",
-        reply_markup=get_main_menu_keyboard(),
-        parse_mode=ParseMode.HTML
+    await edit_message(
+        query.message,
+        MAIN_MENU_TEXT,
+        reply_markup=MAIN_MENU_KEYBOARD
     )
 
 async def show_notifications_menu(query, user_id):
@@ -1088,18 +1654,7 @@ async def show_notifications_menu(query, user_id):
     notif_data = notifications.get(user_id, {})
     
     if not notif_data:
-        text = (
-            "⏰ <b>Настройка уведомлений</b>\n\n"
-            "<i>Получайте ежедневный прогноз погоды!</i>\n\n"
-            "<b>Как настроить:</b>\n"
-            "1. 📍 Выберите город\n"
-            "2. ⏰ Укажите время (UTC)\n"
-            "3. 🔔 Включите уведомления\n\n"
-            "<i>Пример для Москвы (UTC+3):</i>\n"
-            "<i>Для получения уведомления в 9:00 по Москве</i>\n"
-            "<i>выберите 6:00 UTC</i>\n\n"
-            "💾 <i>Все настройки сохраняются автоматически</i>"
-        )
+        text = NOTIF_MENU_EMPTY_TEXT
     else:
         city = notif_data.get("city", "Не выбран")
         utc_time = notif_data.get("utc_time", "Не установлено")
@@ -1115,52 +1670,54 @@ async def show_notifications_menu(query, user_id):
             f"💾 <i>Настройки сохранены: {datetime.now().strftime('%d.%m.%Y %H:%M')}</i>"
         )
     
-    await query.edit_message_text(
+    await edit_message(
+        query.message,
         text,
-        reply_markup=get_notification_keyboard(user_id),
-        parse_mode=ParseMode.HTML
+        reply_markup=get_notification_keyboard(user_id)
     )
 
 async def get_weather_for_user(query, user_id: int, city: str):
     """🌤️ Получить погоду для пользователя"""
-    await query.edit_message_text(
-        f"⏳ <b>Ищу погоду для {city}...</b>",
-        parse_mode=ParseMode.HTML
-    )
-    
-    forecast = await get_weather_async(city)
+    lock, users = weather_locks.get(user_id, (None, 0))
+    lock = lock or asyncio.Lock()
+    weather_locks[user_id] = (lock, users + 1)
+    try:
+        async with lock:
+            await show_weather(query, city)
+    finally:
+        # Последний запрос убирает замок, чтобы словарь не рос с числом пользователей
+        lock, users = weather_locks[user_id]
+        if users > 1:
+            weather_locks[user_id] = (lock, users - 1)
+        else:
+            del weather_locks[user_id]
+
+async def show_weather(query, city: str):
+    """🌤️ Показать погоду в сообщении с кнопками"""
+    # Свежий прогноз из кэша показываем сразу, без промежуточного сообщения
+    if cache_get(rendered_weather, city) is None and not get_cached_weather(city):
+        await edit_message(
+            query.message,
+            f"⏳ <b>Ищу погоду для {city}...</b>"
+        )
+    formatted = await get_weather_text(city)
     
-    if forecast:
-        formatted = format_weather_daily(forecast)
-        
-        keyboard = [
-            [InlineKeyboardButton("🔄 Обновить", callback_data="weather_now")],
-            [InlineKeyboardButton("📍 Сменить город", callback_data="find_city")],
-            [InlineKeyboardButton("⏰ Настроить уведомления", callback_data="notifications")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="back_main")]
-        ]
-        
-        await query.edit_message_text(
+    if formatted:
+        await edit_message(
+            query.message,
             formatted,
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.HTML
+            reply_markup=WEATHER_KEYBOARD
         )
     else:
-        keyboard = [
-            [InlineKeyboardButton("🔍 Найти другой город", callback_data="find_city")],
-            [InlineKeyboardButton("🌍 Поиск по регионам", callback_data="regions")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="back_main")]
-        ]
-        
-        await query.edit_message_text(
+        await edit_message(
+            query.message,
             f"❌ <b>Не удалось найти погоду для '{city}'</b>\n\n"
             f"<i>Попробуйте:</i>\n"
             f"• Проверить написание города\n"
             f"• Поискать в другом регионе\n"
             f"• Использовать английское название\n\n"
             f"<b>Или выберите из вариантов:</b>",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.HTML
+            reply_markup=WEATHER_NOT_FOUND_KEYBOARD
         )
 
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -1171,6 +1728,11 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if not text or text.startswith('/'):
         return
     
+    # Заведомо неверный ввод отсекаем до запросов к API
+    if not is_valid_city_name(text):
+        await update.message.reply_text(INVALID_CITY_TEXT, parse_mode=ParseMode.HTML)
+        return
+    
     # Проверяем, не вводит ли пользователь город для уведомлений
     current_state = context.user_data.get('waiting_for_notification_city', False)
     
@@ -1194,15 +1756,10 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
                 parse_mode=ParseMode.HTML
             )
         else:
-            keyboard = [
-                [InlineKeyboardButton("🔍 Попробовать снова", callback_data="notif_city")],
-                [InlineKeyboardButton("⏰ Назад к уведомлениям", callback_data="notifications")]
-            ]
-            
             await update.message.reply_text(
                 f"❌ <b>Не удалось найти город '{text}'</b>\n\n"
                 f"<i>Попробуйте другой город или используйте псевдоним</i>",
-                reply_markup=InlineKeyboardMarkup(keyboard),
+                reply_markup=NOTIF_CITY_NOT_FOUND_KEYBOARD,
                 parse_mode=ParseMode.HTML
             )
         return
@@ -1220,49 +1777,31 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
         lat, lon, city_name = city_data
         set_user_city(user_id, city_name)
         
-        await message.edit_text(
+        await edit_message(
+            message,
             f"✅ <b>Найден город:</b> {city_name}\n\n"
-            f"⏳ <b>Загружаю погоду...</b>",
-            parse_mode=ParseMode.HTML
+            f"⏳ <b>Загружаю погоду...</b>"
         )
         
-        forecast = await get_weather_async(city_name)
+        # Тот же кэш готового текста, что у кнопки "Погода сейчас" и рассылки
+        formatted = await get_weather_text(city_name)
         
-        if forecast:
-            formatted = format_weather_daily(forecast)
-            
-            keyboard = [
-                [InlineKeyboardButton("📍 Сменить город", callback_data="find_city")],
-                [InlineKeyboardButton("⏰ Настроить уведомления", callback_data="notifications")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_main")]
-            ]
-            
-            await message.edit_text(
+        if formatted:
+            await edit_message(
+                message,
                 formatted,
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.HTML
+                reply_markup=SEARCH_RESULT_KEYBOARD
             )
         else:
-            keyboard = [
-                [InlineKeyboardButton("🔍 Найти другой город", callback_data="find_city")],
-                [InlineKeyboardButton("🌍 Поиск по регионам", callback_data="regions")],
-                [InlineKeyboardButton("🏠 Главное меню", callback_data="back_main")]
-            ]
-            
-            await message.edit_text(
+            await edit_message(
+                message,
                 f"❌ <b>Найден город {city_name}, но нет данных о погоде</b>\n\n"
                 f"<i>Попробуйте другой город</i>",
-                reply_markup=InlineKeyboardMarkup(keyboard),
-                parse_mode=ParseMode.HTML
+                reply_markup=WEATHER_NOT_FOUND_KEYBOARD
             )
     else:
-        keyboard = [
-            [InlineKeyboardButton("🔍 Попробовать снова", callback_data="find_city")],
-            [InlineKeyboardButton("🌍 Поиск по регионам", callback_data="regions")],
-            [InlineKeyboardButton("🏠 Главное меню", callback_data="back_main")]
-        ]
-        
-        await message.edit_text(
+        await edit_message(
+            message,
             f"❌ <b>Не удалось найти город '{text}'</b>\n\n"
             f"<i>Попробуйте:</i>\n"
             f"• Уточнить название\n"
@@ -1270,114 +1809,163 @@ async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"• Искать по региону\n"
             f"• Использовать псевдоним (йошкар дыра, спб и т.д.)\n\n"
             f"<b>Или выберите другой способ поиска:</b>",
-            reply_markup=InlineKeyboardMarkup(keyboard),
-            parse_mode=ParseMode.HTML
+            reply_markup=CITY_NOT_FOUND_KEYBOARD
         )
 
 async def error_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     """❌ Обработчик ошибок"""
-    logger.error(f"❌ Ошибка: {context.error}", exc_info=True)
+    logger.error("❌ Ошибка: %s", context.error, exc_info=True)
     
     if update and update.effective_message:
         try:
-            error_text = (
-                "❌ <b>Произошла ошибка</b>\n\n"
-                "<i>Попробуйте снова или выберите действие из меню</i>"
-            )
-            
             await update.effective_message.reply_text(
-                error_text,
-                reply_markup=get_main_menu_keyboard(),
+                ERROR_TEXT,
+                reply_markup=MAIN_MENU_KEYBOARD,
                 parse_mode=ParseMode.HTML
             )
         except:
             pass
 
 # ============= СИСТЕМА УВЕДОМЛЕНИЙ =============
-async def check_and_send_notifications(app):
-    """🔔 Проверка и отправка уведомлений"""
-    current_utc = datetime.utcnow().strftime("%H:%M")
-    current_date = datetime.utcnow().date()
-    
-    logger.info(f"🔍 Проверка уведомлений в {current_utc} UTC")
-    
-    for user_id, notif_data in list(notifications.items()):
-        try:
-            if not notif_data.get("enabled", False):
-                continue
+# Ограничение одновременных отправок уведомлений
+notification_semaphore = asyncio.Semaphore(Config.NOTIFICATION_CONCURRENCY)
+
+async def send_notification(app, user_id, current_date) -> bool:
+    """🔔 Отправка уведомления одному пользователю"""
+    try:
+        notif_data = notifications.get(user_id)
+        if not notif_data:
+            return False
+        utc_time = notif_data["utc_time"]
+        
+        # Проверяем, не отправляли ли уже сегодня
+        last_sent = last_notification.get(user_id)
+        if last_sent == current_date:
+            return False
+        
+        city = notif_data.get("city", get_user_city(user_id))
+        if not city or city == "Не выбран":
+            return False
+        
+        async with notification_semaphore:
+            # Пользователи одного города получают один общий прогноз и текст
+            formatted = await get_weather_text(city)
+            if not formatted:
+                return False
             
-            utc_time = notif_data.get("utc_time")
-            if not utc_time:
-                continue
+            # Добавляем приветствие
+            hour = int(utc_time.split(":")[0])
+            if hour < 12:
+                greeting = "🌅 Доброе утро!"
+            elif hour < 18:
+                greeting = "🌇 Добрый день!"
+            else:
+                greeting = "🌃 Добрый вечер!"
             
-            # Проверяем, не отправляли ли уже сегодня
-            last_sent = last_notification.get(user_id)
-            if last_sent == current_date:
-                continue
+            message_text = f"{greeting}\n\n{formatted}"
             
-            # Проверяем время (допуск ±1 минута)
-            if abs((datetime.strptime(utc_time, "%H:%M") - datetime.strptime(current_utc, "%H:%M")).total_seconds()) <= 60:
-                city = notif_data.get("city", get_user_city(user_id))
-                if not city or city == "Не выбран":
-                    continue
-                
-                forecast = await get_weather_async(city)
-                if forecast:
-                    formatted = format_weather_daily(forecast)
-                    
-                    # Добавляем приветствие
-                    hour = int(utc_time.split(":")[0])
-                    if hour < 12:
-                        greeting = "🌅 Доброе утро!"
-                    elif hour < 18:
-                        greeting = "🌇 Добрый день!"
-                    else:
-                        greeting = "🌃 Добрый вечер!"
-                    
-                    message_text = f"{greeting}\n\n{formatted}"
-                    
-                    try:
-                        await app.bot.send_message(
-                            chat_id=user_id,
-                            text=message_text,
-                            parse_mode=ParseMode.HTML
-                        )
-                        
-                        logger.info(f"✅ Отправлено уведомление пользователю {user_id} для города {city}")
-                        last_notification[user_id] = current_date
-                        
-                        # Сохраняем факт отправки
-                        save_data_to_file()
-                        
-                    except Exception as e:
-                        logger.error(f"❌ Ошибка отправки сообщения пользователю {user_id}: {e}")
-                    
-        except Exception as e:
-            logger.error(f"❌ Ошибка обработки уведомления для пользователя {user_id}: {e}")
-
-def notification_worker(app):
-    """👷‍♂️ Рабочий поток для уведомлений"""
-    async def worker_loop():
-        while True:
             try:
-                await check_and_send_notifications(app)
-                await asyncio.sleep(30)  # Проверяем каждые 30 секунд
+                await app.bot.send_message(
+                    chat_id=user_id,
+                    text=message_text,
+                    parse_mode=ParseMode.HTML
+                )
             except Exception as e:
-                logger.error(f"❌ Ошибка в worker_loop: {e}")
-                await asyncio.sleep(60)
+                logger.error("❌ Ошибка отправки сообщения пользователю %s: %s", user_id, e)
+                return False
+        
+        logger.info("✅ Отправлено уведомление пользователю %s для города %s", user_id, city)
+        last_notification[user_id] = current_date
+        return True
+        
+    except Exception as e:
+        logger.error("❌ Ошибка обработки уведомления для пользователя %s: %s", user_id, e)
+        return False
+
+async def check_and_send_notifications(app, due_slots):
+    """🔔 Отправка уведомлений, запланированных на указанное время"""
+    current_date = datetime.utcnow().date()
     
-    def run_worker():
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        loop.run_until_complete(worker_loop())
+    logger.debug("🔍 Рассылка уведомлений на %s UTC", ", ".join(due_slots))
     
-    worker_thread = threading.Thread(target=run_worker, daemon=True)
-    worker_thread.start()
-    logger.info("✅ Служба уведомлений запущена")
+    due_users = [user_id for slot in due_slots for user_id in notifications_by_time.get(slot, ())]
+    if not due_users:
+        return
+    
+    # Рассылаем параллельно, а не по одному пользователю за раз.
+    # gather, а не TaskGroup: ошибка одной отправки не должна отменять остальные
+    results = await asyncio.gather(*(send_notification(app, user_id, current_date) for user_id in due_users))
+    
+    # Сохраняем факт отправки один раз на всю рассылку
+    if any(results):
+        mark_data_dirty()
+
+async def notification_job(context: ContextTypes.DEFAULT_TYPE):
+    """👷‍♂️ Рассылка уведомлений в назначенное время"""
+    await check_and_send_notifications(context.application, context.job.data)
+
+def schedule_notifications(app: Application):
+    """⏰ Ежедневная задача на каждое время уведомлений"""
+    # Бот просыпается только тогда, когда есть что отправлять, и не
+    # проверяет время по кругу. Кому отправлять, решает индекс
+    # в момент срабатывания, поэтому изменения настроек задач не трогают
+    slots = set(Config.TIME_SLOTS) | set(notifications_by_time)
+    for slot in sorted(slots):
+        hour, minute = map(int, slot.split(":"))
+        app.job_queue.run_daily(
+            notification_job,
+            time=dt_time(hour, minute, tzinfo=timezone.utc),
+            data=(slot,),
+            name=f"notifications_{slot}",
+            job_kwargs={"misfire_grace_time": Config.NOTIFICATION_GRACE_PERIOD}
+        )
+    
+    # Время, наступившее прямо перед запуском, задачи уже пропустили
+    now = datetime.utcnow()
+    missed = (now - timedelta(seconds=Config.NOTIFICATION_GRACE_PERIOD)).strftime("%H:%M")
+    current = now.strftime("%H:%M")
+    app.job_queue.run_once(
+        notification_job, when=0, data=tuple({missed, current}), name="notifications_catch_up"
+    )
 
 # ============= ОСНОВНАЯ ФУНКЦИЯ =============
+async def post_init(app: Application):
+    """🚀 Запуск фоновых служб в event loop бота"""
+    get_http_session()
+    
+    # JobQueue останавливается вместе с ботом, отдельные потоки и циклы не нужны
+    schedule_notifications(app)
+    app.job_queue.run_repeating(
+        flush_data_job, interval=Config.SAVE_DEBOUNCE_INTERVAL, name="flush_data"
+    )
+    app.job_queue.run_repeating(
+        auto_save_job, interval=Config.AUTO_SAVE_INTERVAL, first=Config.AUTO_SAVE_INTERVAL, name="auto_save"
+    )
+    if Config.RENDER_WAKEUP_URL:
+        app.job_queue.run_repeating(
+            render_wakeup_job, interval=Config.RENDER_WAKEUP_INTERVAL, first=0, name="render_wakeup"
+        )
+    
+    logger.info("✅ Службы уведомлений и автосохранения запущены")
+
+async def post_shutdown(app: Application):
+    """🛑 Освобождение ресурсов после остановки бота"""
+    # Изменения за последние секунды еще не записаны
+    if data_dirty:
+        await save_data_to_file()
+    await save_caches_to_file()
+    await close_http_session()
+
 def main():
     """🚀 Запуск бота"""
+    # ⚡ Быстрый event loop (uvloop), если доступен
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("⚡ Используется event loop uvloop")
+    except ImportError:
+        logger.info("🐢 uvloop не установлен, используется стандартный event loop")
+    
     if not Config.BOT_TOKEN:
         logger.error("❌ BOT_TOKEN не установлен!")
         logger.info("📝 Установите переменную окружения BOT_TOKEN на Render.com")
@@ -1388,17 +1976,32 @@ def main():
     if not load_data_from_file():
         logger.info("📝 Файл с данными не найден, начинаем с чистого листа")
     
-    # Даем время предыдущему экземпляру завершиться
-    logger.info("⏳ Ожидание завершения предыдущего экземпляра...")
-    time.sleep(3)
+    # Ждать предыдущий экземпляр не нужно: пока он держит getUpdates, Telegram
+    # отвечает Conflict, и polling сам повторяет запрос с нарастающей паузой
     
     logger.info("🤖 Бот запускается...")
     logger.info("🌍 Использую умный поиск городов через API")
     logger.info("✨ Готов к работе с любыми городами!")
-    logger.info(f"💾 Данные пользователей: {len(user_sessions)}")
-    logger.info(f"🔔 Настроенных уведомлений: {len(notifications)}")
-    
-    app = Application.builder().token(Config.BOT_TOKEN).build()
+    logger.info("💾 Данные пользователей: %s", len(user_sessions))
+    logger.info("🔔 Настроенных уведомлений: %s, включено: %s", len(notifications), len(notification_slots))
+    
+    app = (
+        Application.builder()
+        .token(Config.BOT_TOKEN)
+        .connection_pool_size(Config.TG_CONNECTION_POOL_SIZE)
+        .get_updates_connection_pool_size(Config.TG_GET_UPDATES_POOL_SIZE)
+        .pool_timeout(Config.TG_POOL_TIMEOUT)
+        .connect_timeout(Config.TG_CONNECT_TIMEOUT)
+        .read_timeout(Config.TG_READ_TIMEOUT)
+        .rate_limiter(AIORateLimiter(
+            overall_max_rate=Config.TG_OVERALL_MAX_RATE,
+            group_max_rate=Config.TG_GROUP_MAX_RATE,
+            max_retries=Config.TG_MAX_RETRIES
+        ))
+        .post_init(post_init)
+        .post_shutdown(post_shutdown)
+        .build()
+    )
     
     # Регистрируем обработчики
     app.add_handler(CommandHandler("start", start))
@@ -1407,17 +2010,11 @@ def main():
     app.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
     app.add_error_handler(error_handler)
     
-    # Запускаем службы
-    notification_worker(app)
-    auto_save_worker()
-    
-    if Config.RENDER_WAKEUP_URL:
-        render_wakeup_worker()
-    
+    # Уведомления, автосохранение и пробуждение запускаются в post_init
     logger.info("✅ Бот запущен и ожидает сообщений...")
     logger.info("✨ Готов к работе!")
     logger.info("💾 Автосохранение данных каждые 5 минут")
-    logger.info(f"⏰ Пробуждение Render каждые {Config.RENDER_WAKEUP_INTERVAL} секунд")
+    logger.info("⏰ Пробуждение Render каждые %s секунд", Config.RENDER_WAKEUP_INTERVAL)
     
     # Запускаем polling
     app.run_polling(
@@ -22,6 +22,7 @@ class Config:
     MAX_RETRIES = 3
     RETRY_DELAY = 5
     TIMEOUT = 30  # секунд
+    CONNECT_TIMEOUT = 5  # секунд на соединение: сервер просыпается долго, но соединение принимается сразу
 
 # ============= ЛОГГИРОВАНИЕ =============
 logging.basicConfig(
@@ -35,7 +36,7 @@ logging.basicConfig(
 logger = logging.getLogger(__name__)
 
 # ============= ОСНОВНЫЕ ФУНКЦИИ =============
-async def wakeup_render_once():
+async def wakeup_render_once(session: aiohttp.ClientSession):
     """🔄 Однократное пробуждение Render.com"""
     if not Config.RENDER_WAKEUP_URL:
         logger.warning("⚠️ RENDER_WAKEUP_URL не установлен")
@@ -47,22 +48,16 @@ async def wakeup_render_once():
             
             start_time = time.time()
             
-            async with aiohttp.ClientSession() as session:
-                timeout = aiohttp.ClientTimeout(total=Config.TIMEOUT)
+            async with session.get(Config.RENDER_WAKEUP_URL) as response:
                 
-                async with session.get(
-                    Config.RENDER_WAKEUP_URL, 
-                    timeout=timeout
-                ) as response:
-                    
-                    elapsed = time.time() - start_time
+                elapsed = time.time() - start_time
+                
+                if response.status in [200, 201, 202, 204]:
+                    logger.info(f"✅ Render пробужден за {elapsed:.2f} сек, статус: {response.status}")
+                    return True
+                else:
+                    logger.warning(f"⚠️ Render ответил статусом {response.status} за {elapsed:.2f} сек")
                     
-                    if response.status in [200, 201, 202, 204]:
-                        logger.info(f"✅ Render пробужден за {elapsed:.2f} сек, статус: {response.status}")
-                        return True
-                    else:
-                        logger.warning(f"⚠️ Render ответил статусом {response.status} за {elapsed:.2f} сек")
-                        
         except aiohttp.ClientError as e:
             logger.error(f"❌ Ошибка сети: {e}")
         except asyncio.TimeoutError:
@@ -87,6 +82,10 @@ async def wakeup_render_continuous():
     wakeup_count = 0
     success_count = 0
     
+    # Одна сессия на всю работу службы: соединение с Render переиспользуется
+    timeout = aiohttp.ClientTimeout(total=Config.TIMEOUT, connect=Config.CONNECT_TIMEOUT)
+    session = aiohttp.ClientSession(timeout=timeout)
+    
     try:
         while True:
             wakeup_count += 1
@@ -96,7 +95,7 @@ async def wakeup_render_continuous():
             logger.info(f"🔄 Пробуждение #{wakeup_count} в {current_time}")
             logger.info(f"{'='*50}")
             
-            success = await wakeup_render_once()
+            success = await wakeup_render_once(session)
             
             if success:
                 success_count += 1
@@ -120,6 +119,7 @@ async def wakeup_render_continuous():
         logger.error(f"❌ Критическая ошибка в wakeup_loop: {e}")
     
     finally:
+        await session.close()
         logger.info(f"\n{'='*50}")
         logger.info("🛑 Служба пробуждения остановлена")
         logger.info(f"📊 Итоговая статистика: {success_count}/{wakeup_count} успешных")
@@ -134,6 +134,10 @@ async def health_check():
         except Exception as e:
             logger.error(f"❌ Ошибка в health check: {e}")
 
+async def run_service():
+    """🔄 Пробуждение и health check в одном event loop"""
+    await asyncio.gather(wakeup_render_continuous(), health_check())
+
 def main():
     """🚀 Главная функция"""
     if not Config.RENDER_WAKEUP_URL:
@@ -142,38 +146,27 @@ def main():
         logger.info("📝 Пример: https://your-bot-name.onrender.com")
         return
     
+    # ⚡ Быстрый event loop (uvloop), если доступен
+    try:
+        import uvloop
+        uvloop.install()
+        logger.info("⚡ Используется event loop uvloop")
+    except ImportError:
+        logger.info("🐢 uvloop не установлен, используется стандартный event loop")
+    
     logger.info("🚀 Запуск службы пробуждения Render.com")
     logger.info(f"🔄 URL: {Config.RENDER_WAKEUP_URL}")
     logger.info(f"⏰ Интервал: {Config.WAKEUP_INTERVAL} сек")
     logger.info(f"🔄 Максимум попыток: {Config.MAX_RETRIES}")
     
     try:
-        # Создаем event loop
-        loop = asyncio.new_event_loop()
-        asyncio.set_event_loop(loop)
-        
-        # Создаем задачи
-        tasks = [
-            loop.create_task(wakeup_render_continuous()),
-            loop.create_task(health_check())
-        ]
-        
-        # Запускаем все задачи
-        loop.run_until_complete(asyncio.gather(*tasks))
-        
+        # asyncio.run сам создает event loop и закрывает его по завершении
+        asyncio.run(run_service())
     except KeyboardInterrupt:
         logger.info("\n👋 Остановка по Ctrl+C")
     except Exception as e:
         logger.error(f"❌ Фатальная ошибка: {e}")
     finally:
-        # Аккуратно закрываем loop
-        try:
-            loop = asyncio.get_event_loop()
-            if not loop.is_closed():
-                loop.close()
-        except:
-            pass
-        
         logger.info("🛑 Служба полностью остановлена")
 
 if __name__ == "__main__":
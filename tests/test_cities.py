@@ -0,0 +1,53 @@
+import asyncio
+
+import pytest
+
+import bot
+
+
+@pytest.fixture
+def geocoder_calls(monkeypatch):
+    """Подменяет геокодер и запоминает, какие города до него дошли"""
+    calls = []
+
+    async def fake_geocode_city(city_name, cache_key):
+        calls.append(city_name)
+        return None
+
+    monkeypatch.setattr(bot, "geocode_city", fake_geocode_city)
+    return calls
+
+
+@pytest.mark.parametrize("city", ["Пинск", "Томск"])
+def test_similar_real_city_reaches_geocoder(city, geocoder_calls):
+    # "нск"/"мск" внутри названия и опечатка в "Минск" не должны подменять город
+    assert bot.get_known_city(city) is None
+    asyncio.run(bot.search_city_api(city))
+    assert geocoder_calls == [city]
+
+
+@pytest.mark.parametrize("city, expected", [
+    ("мск", "Москва"),
+    ("г. спб", "Санкт-Петербург"),
+    ("Минск", "Минск"),
+])
+def test_alias_or_known_city_resolved_locally(city, expected, geocoder_calls):
+    assert asyncio.run(bot.search_city_api(city))[2] == expected
+    assert geocoder_calls == []
+
+
+def test_stale_city_button_pattern():
+    # Устаревшими считаются только кнопки городов, а не любые действия на "c"
+    assert bot.city_callback_pattern.fullmatch(bot.city_callback_data("Тверь"))
+    for action in ("cancel", "city", "c123", "cXYZXYZXYZX"):
+        assert not bot.city_callback_pattern.fullmatch(action)
+
+
+@pytest.mark.parametrize("text", ["Москва", "Санкт-Петербург", "St. John's", "Ростов (на Дону)"])
+def test_city_name_accepted(text):
+    assert bot.is_valid_city_name(text)
+
+
+@pytest.mark.parametrize("text", ["123", "___", "Москва2", "--", "🌧️🌧️"])
+def test_invalid_city_name_rejected(text):
+    assert not bot.is_valid_city_name(text)